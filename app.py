@@ -14,7 +14,8 @@ import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
 import io
-from shapely.geometry import Polygon, Point, LineString, mapping
+import shapely
+from shapely.geometry import Polygon, MultiPolygon, Point, LineString, mapping
 from shapely.validation import make_valid
 import math
 import warnings
@@ -35,6 +36,10 @@ import base64
 import time
 import sqlite3
 import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 
 # ===== LIBRERÍAS PARA DATOS SATELITALES =====
 try:
@@ -59,6 +64,19 @@ try:
 except ImportError:
     PYHDF_OK = False
 
+# ===== LECTURA RÁPIDA DE CAPAS VECTORIALES =====
+try:
+    import pyogrio
+    PYOGRIO_OK = True
+except ImportError:
+    PYOGRIO_OK = False
+
+try:
+    import pyarrow
+    ARROW_OK = True
+except ImportError:
+    ARROW_OK = False
+
 # ===== CONFIGURACIÓN DE PÁGINA =====
 st.set_page_config(
     page_title="Analizador de Palma Aceitera",
@@ -125,6 +143,8 @@ def init_session_state():
         'datos_climaticos': {},
         'deteccion_ejecutada': False,
         'n_divisiones': 16,
+        'forma_bloque': 'cuadrada',
+        'tamano_bloque_m': None,
         'fecha_inicio': datetime.now() - timedelta(days=60),
         'fecha_fin': datetime.now(),
         'variedad_seleccionada': 'Tenera (DxP)',
@@ -133,6 +153,12 @@ def init_session_state():
         'datos_fertilidad': [],
         'analisis_suelo': True,
         'curvas_nivel': None,
+        'pixeles_sesion': {},
+        'lotes': None,
+        'resultados_lotes': None,
+        'clima_por_bloque': False,
+        'fuente_clima': 'openmeteo',
+        'metodo_clima_local': 'bilinear',
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -171,168 +197,364 @@ def validar_y_corregir_crs(gdf):
         st.warning(f"⚠️ Error al corregir CRS: {e}")
         return gdf
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def _areas_hectareas(clave, _geometrias):
+    """Áreas (ha) en una proyección acimutal de Lambert de igual área centrada en las geometrías."""
+    serie = gpd.GeoSeries(_geometrias, crs='EPSG:4326')
+    minx, miny, maxx, maxy = serie.total_bounds
+    crs_igual_area = f"+proj=laea +lat_0={(miny + maxy) / 2} +lon_0={(minx + maxx) / 2} +datum=WGS84 +units=m"
+    return serie.to_crs(crs_igual_area).area.to_numpy() / 10000
+
+def areas_hectareas(gdf):
+    """Área en hectáreas de cada geometría (array numpy), memorizada por el WKB de las geometrías."""
+    gdf = validar_y_corregir_crs(gdf)
+    geometrias = np.asarray(gdf.geometry)
+    clave = hashlib.sha1(b''.join(shapely.to_wkb(geometrias))).hexdigest()
+    return _areas_hectareas(clave, geometrias)
+
 def calcular_superficie(gdf):
     try:
         if gdf is None or len(gdf) == 0:
             return 0.0
-        gdf = validar_y_corregir_crs(gdf)
-        bounds = gdf.total_bounds
-        if bounds[0] < -180 or bounds[2] > 180 or bounds[1] < -90 or bounds[3] > 90:
-            area_grados2 = gdf.geometry.area.sum()
-            area_m2 = area_grados2 * 111000 * 111000
-            return area_m2 / 10000
-        gdf_projected = gdf.to_crs('EPSG:3857')
-        area_m2 = gdf_projected.geometry.area.sum()
-        return area_m2 / 10000
+        return float(areas_hectareas(gdf).sum())
     except Exception as e:
         st.warning(f"⚠️ No se pudo calcular el área: {e}")
         return 0.0
 
-def dividir_plantacion_en_bloques(gdf, n_bloques):
+FORMAS_BLOQUE = {'cuadrada': 'Cuadrada', 'hexagonal': 'Hexagonal'}
+MAX_BLOQUES = 10000
+
+def tamano_celda_para_bloques(area_m2, n_bloques, forma='cuadrada'):
+    """Tamaño de celda (m) que reparte area_m2 en unos n_bloques: lado del cuadrado o ancho del hexágono."""
+    # Hexágono de ancho w (entre lados paralelos): área = sqrt(3)/2 * w²
+    factor = 1.0 if forma == 'cuadrada' else math.sqrt(3) / 2
+    return math.sqrt(area_m2 / max(n_bloques, 1) / factor)
+
+def rejilla_celdas(limites, tamano, forma='cuadrada'):
+    """Celdas (array de polígonos shapely) que cubren los límites, en filas de sur a norte."""
+    minx, miny, maxx, maxy = limites
+    if forma == 'cuadrada':
+        xs = np.arange(minx, maxx, tamano)
+        ys = np.arange(miny, maxy, tamano)
+        x0, y0 = np.meshgrid(xs, ys)
+        return shapely.box(x0.ravel(), y0.ravel(), x0.ravel() + tamano, y0.ravel() + tamano)
+    # Hexágonos con vértice arriba: radio r, ancho sqrt(3) r, filas cada 1.5 r desplazadas medio ancho
+    r = tamano / math.sqrt(3)
+    ys = np.arange(miny, maxy + r, 1.5 * r)
+    xs = np.arange(minx, maxx + tamano, tamano)
+    cx, cy = np.meshgrid(xs, ys)
+    cx = cx + np.where(np.arange(len(ys)) % 2 == 1, tamano / 2, 0.0)[:, None]
+    angulos = np.radians(30 + 60 * np.arange(7))
+    vertices = np.stack([cx.ravel()[:, None] + r * np.cos(angulos),
+                         cy.ravel()[:, None] + r * np.sin(angulos)], axis=-1)
+    return shapely.polygons(vertices)
+
+def crs_utm(gdf):
+    """CRS UTM WGS84 de la zona que contiene el centro de la capa (sin consultar la base de datos de pyproj)."""
+    minx, miny, maxx, maxy = gdf.total_bounds
+    zona = int((((minx + maxx) / 2 + 180) // 6) % 60) + 1
+    return f"EPSG:{(32600 if (miny + maxy) / 2 >= 0 else 32700) + zona}"
+
+def configuracion_division():
+    """(n_bloques, forma, tamano_m) elegidos en la barra lateral; identifica una división."""
+    return (st.session_state.get('n_divisiones', 16), st.session_state.get('forma_bloque', 'cuadrada'),
+            st.session_state.get('tamano_bloque_m'))
+
+def dividir_plantacion_en_bloques(gdf, n_bloques=16, forma='cuadrada', tamano_m=None):
+    """
+    Divide la plantación en celdas cuadradas o hexagonales de tamano_m metros
+    (o del tamaño que da unos n_bloques). Las celdas se generan como arrays y
+    se recortan en bloque: solo las del borde se intersectan con el polígono.
+    """
     if gdf is None or len(gdf) == 0:
         return gdf
     gdf = validar_y_corregir_crs(gdf)
-    plantacion_principal = gdf.iloc[0].geometry
-    bounds = plantacion_principal.bounds
-    minx, miny, maxx, maxy = bounds
-    sub_poligonos = []
-    n_cols = math.ceil(math.sqrt(n_bloques))
-    n_rows = math.ceil(n_bloques / n_cols)
-    width = (maxx - minx) / n_cols
-    height = (maxy - miny) / n_rows
-
-    for i in range(n_rows):
-        for j in range(n_cols):
-            if len(sub_poligonos) >= n_bloques:
-                break
-            cell_minx = minx + (j * width)
-            cell_maxx = minx + ((j + 1) * width)
-            cell_miny = miny + (i * height)
-            cell_maxy = miny + ((i + 1) * height)
-            cell_poly = Polygon([
-                (cell_minx, cell_miny), (cell_maxx, cell_miny),
-                (cell_maxx, cell_maxy), (cell_minx, cell_maxy)
-            ])
-            intersection = plantacion_principal.intersection(cell_poly)
-            if not intersection.is_empty and intersection.area > 0:
-                sub_poligonos.append(intersection)
-
-    if sub_poligonos:
-        nuevo_gdf = gpd.GeoDataFrame(
-            {'id_bloque': range(1, len(sub_poligonos) + 1), 'geometry': sub_poligonos},
-            crs='EPSG:4326'
-        )
-        return nuevo_gdf
-    return gdf
+    crs_metrico = crs_utm(gdf)
+    plantacion = shapely.union_all(shapely.make_valid(np.asarray(gdf.to_crs(crs_metrico).geometry)))
+    if plantacion.is_empty or plantacion.area <= 0:
+        return gdf
+    if tamano_m is None:
+        tamano_m = tamano_celda_para_bloques(plantacion.area, n_bloques, forma)
+    minimo = tamano_celda_para_bloques(plantacion.area, MAX_BLOQUES, forma)
+    if tamano_m < minimo:
+        st.warning(f"⚠️ Celdas de {tamano_m:.0f} m darían más de {MAX_BLOQUES} bloques; se usan celdas de {minimo:.0f} m.")
+        tamano_m = minimo
+
+    celdas = rejilla_celdas(plantacion.bounds, tamano_m, forma)
+    shapely.prepare(plantacion)
+    celdas = celdas[shapely.intersects(plantacion, celdas)]
+    interiores = shapely.contains_properly(plantacion, celdas)
+    bloques = celdas.copy()
+    bloques[~interiores] = shapely.intersection(celdas[~interiores], plantacion)
+    # Los recortes pueden dejar colecciones con líneas o puntos sueltos: solo interesa la parte poligonal
+    colecciones = np.nonzero(shapely.get_type_id(bloques) == 7)[0]
+    for i in colecciones:
+        partes = [p for p in shapely.get_parts(bloques[i]) if p.area > 0]
+        bloques[i] = shapely.union_all(partes) if partes else shapely.Polygon()
+    bloques = bloques[shapely.area(bloques) > 0]
+    if len(bloques) == 0:
+        return gdf
+
+    return gpd.GeoDataFrame(
+        {'id_bloque': np.arange(1, len(bloques) + 1)},
+        geometry=gpd.GeoSeries(bloques, crs=crs_metrico).to_crs('EPSG:4326').values,
+        crs='EPSG:4326'
+    )
 
 # ===== PARSER KML MEJORADO =====
-def procesar_kml_robusto(file_content):
+def _etiqueta(elemento):
+    """Nombre del elemento sin espacio de nombres ('{http://www.opengis.net/kml/2.2}Polygon' -> 'Polygon')."""
+    return elemento.tag.rsplit('}', 1)[-1]
+
+def _punto_kml(tupla):
+    """(lon, lat) de una tupla 'lon,lat[,alt]'; None si no es numérica."""
     try:
-        content = file_content.decode('utf-8', errors='ignore')
-        polygons = []
-        coord_sections = re.findall(
-            r'<coordinates[^>]*>([\s\S]*?)</coordinates>',
-            content,
-            re.IGNORECASE | re.DOTALL
-        )
-        for coord_text in coord_sections:
-            coord_text = coord_text.strip()
-            if not coord_text:
-                continue
-            coord_list = []
-            coords = re.split(r'[\s\n\t]+', coord_text)
-            for coord in coords:
-                coord = coord.strip()
-                if not coord or ',' not in coord:
-                    continue
-                try:
-                    parts = [p.strip() for p in coord.split(',')]
-                    if len(parts) >= 2:
-                        lon = float(parts[0])
-                        lat = float(parts[1])
-                        if -180 <= lon <= 180 and -90 <= lat <= 90:
-                            coord_list.append((lon, lat))
-                except ValueError:
-                    continue
-            if len(coord_list) >= 3:
-                if coord_list[0] != coord_list[-1]:
-                    coord_list.append(coord_list[0])
-                try:
-                    polygon = Polygon(coord_list)
-                    if polygon.is_valid and polygon.area > 0:
-                        polygons.append(polygon)
-                except Exception:
-                    continue
-        if polygons:
-            return gpd.GeoDataFrame(geometry=polygons, crs='EPSG:4326')
+        lon, lat = tupla.split(',')[:2]
+        return float(lon), float(lat)
+    except ValueError:
+        return None
+
+def coordenadas_kml(texto):
+    """
+    Array (n, 2) lon/lat de un <coordinates> KML, convertido de una vez con
+    numpy. Las tuplas mal formadas se descartan; un anillo vacío da (0, 2).
+    """
+    tuplas = texto.split()
+    if not tuplas:
+        return np.empty((0, 2))
+    dimension = tuplas[0].count(',') + 1
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=DeprecationWarning)
+            valores = np.fromstring(texto.replace(',', ' '), sep=' ')
+    except ValueError:  # texto no numérico
+        valores = np.empty(0)
+    if dimension in (2, 3) and valores.size == dimension * len(tuplas):
+        puntos = valores.reshape(-1, dimension)[:, :2]
+    else:
+        # Tuplas con distinta dimensión (con y sin altitud mezcladas) o con valores no numéricos
+        puntos = np.array([p for p in map(_punto_kml, tuplas) if p is not None], dtype=float).reshape(-1, 2)
+    dentro = (np.abs(puntos[:, 0]) <= 180) & (np.abs(puntos[:, 1]) <= 90)
+    return puntos[dentro]
+
+def _poligono_kml(elemento):
+    """Polygon shapely de un <Polygon> KML con sus huecos (innerBoundaryIs)."""
+    exterior, huecos = None, []
+    for borde in elemento:
+        anillos = [coordenadas_kml(c.text or '') for c in borde.iter() if _etiqueta(c) == 'coordinates']
+        anillos = [a for a in anillos if len(a) >= 3]
+        if _etiqueta(borde) == 'outerBoundaryIs' and anillos:
+            exterior = anillos[0]
+        elif _etiqueta(borde) == 'innerBoundaryIs':
+            huecos.extend(anillos)
+    if exterior is None:
         return None
+    return Polygon(exterior, huecos)
+
+def _placemark_kml(elemento):
+    """Atributos y geometría (Polygon o MultiPolygon) de un Placemark; None si no tiene polígonos."""
+    atributos = {}
+    poligonos = []
+    for hijo in elemento.iter():
+        etiqueta = _etiqueta(hijo)
+        if etiqueta in ('name', 'description') and hijo.text and etiqueta not in atributos:
+            atributos[etiqueta] = hijo.text.strip()
+        elif etiqueta == 'Data' and hijo.get('name'):
+            valor = next((v.text for v in hijo if _etiqueta(v) == 'value'), None)
+            atributos[hijo.get('name')] = valor
+        elif etiqueta == 'SimpleData' and hijo.get('name'):
+            atributos[hijo.get('name')] = hijo.text
+        elif etiqueta == 'Polygon':
+            poligono = _poligono_kml(hijo)
+            if poligono is not None and not poligono.is_empty:
+                poligonos.append(poligono)
+    if not poligonos:
+        return None
+    atributos['geometry'] = poligonos[0] if len(poligonos) == 1 else MultiPolygon(poligonos)
+    return atributos
+
+def procesar_kml_robusto(origen):
+    """
+    Lee un KML (bytes o archivo abierto) de forma incremental con iterparse:
+    cada Placemark se convierte en una fila con sus atributos (name,
+    description, ExtendedData) y su geometría, incluidos huecos y
+    MultiGeometry, y se libera enseguida para no retener el árbol completo.
+    """
+    import xml.etree.ElementTree as ET
+    try:
+        fuente = io.BytesIO(origen) if isinstance(origen, (bytes, bytearray)) else origen
+        filas, omitidos = [], 0
+        for _, elemento in ET.iterparse(fuente, events=('end',)):
+            if _etiqueta(elemento) != 'Placemark':
+                continue
+            # Un Placemark con geometría imposible se descarta, como las geometrías inválidas
+            try:
+                fila = _placemark_kml(elemento)
+            except (ValueError, IndexError):
+                fila, omitidos = None, omitidos + 1
+            if fila is not None:
+                filas.append(fila)
+            elemento.clear()
+        if omitidos:
+            st.warning(f"⚠️ {omitidos} Placemark(s) con coordenadas no válidas omitidos")
+        if not filas:
+            return None
+        gdf = gpd.GeoDataFrame(filas, geometry='geometry', crs='EPSG:4326')
+        invalidas = ~gdf.geometry.is_valid
+        if invalidas.any():
+            gdf.loc[invalidas, 'geometry'] = shapely.make_valid(np.asarray(gdf.geometry[invalidas]))
+        return gdf[gdf.geometry.area > 0].reset_index(drop=True)
     except Exception as e:
         st.error(f"❌ Error en procesamiento KML: {str(e)}")
         return None
 
 # ===== CARGA DE ARCHIVO =====
+COLUMNAS_NOMBRE_LOTE = ('nombre_lote', 'name', 'Name', 'NAME', 'nombre', 'Nombre', 'NOMBRE', 'lote', 'Lote', 'LOTE')
+
+def preparar_lotes(gdf):
+    """
+    Todos los lotes poligonales del archivo con sus atributos, geometrías
+    reparadas en bloque, id_lote correlativo y un nombre legible.
+    """
+    geometrias = np.asarray(gdf.geometry).copy()
+    invalidas = ~shapely.is_valid(geometrias)
+    geometrias[invalidas] = shapely.make_valid(geometrias[invalidas])
+    # make_valid puede devolver colecciones: se conserva solo la parte poligonal
+    colecciones = np.nonzero(shapely.get_type_id(geometrias) == 7)[0]
+    for i in colecciones:
+        partes = [p for p in shapely.get_parts(geometrias[i]) if p.area > 0]
+        geometrias[i] = shapely.union_all(partes) if partes else shapely.Polygon()
+    lotes = gdf.drop(columns=gdf.geometry.name).copy()
+    lotes = gpd.GeoDataFrame(lotes, geometry=geometrias, crs=gdf.crs)
+    lotes = lotes[lotes.geom_type.isin(['Polygon', 'MultiPolygon']) & (shapely.area(geometrias) > 0)]
+    if len(lotes) == 0:
+        return None
+    lotes = lotes.reset_index(drop=True)
+    ids = np.arange(1, len(lotes) + 1)
+    nombres = pd.Series([f"Lote {i}" for i in ids], index=lotes.index)
+    columna_nombre = next((c for c in COLUMNAS_NOMBRE_LOTE if c in lotes.columns), None)
+    if columna_nombre:
+        originales = lotes.pop(columna_nombre).astype('string').str.strip()
+        nombres = originales.where(originales.fillna('') != '', nombres).astype(str)
+    lotes.insert(0, 'id_lote', ids)
+    lotes.insert(1, 'nombre_lote', nombres)
+    return lotes
+
+def poligono_principal(geometrias):
+    """
+    Mayor polígono de la unión de los lotes. Solo se une la componente conexa
+    (lotes que se tocan) de mayor área, y si es una cobertura sin solapes,
+    como un catastro, con coverage_union_all, mucho más rápido que union_all.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    n = len(geometrias)
+    i, j = shapely.STRtree(geometrias).query(geometrias, predicate='intersects')
+    _, componente = connected_components(coo_matrix((np.ones(len(i)), (i, j)), shape=(n, n)), directed=False)
+    areas = shapely.area(geometrias)
+    mayor = componente == np.argmax(np.bincount(componente, weights=areas))
+    try:
+        union = shapely.coverage_union_all(geometrias[mayor])
+        # Sin solapes la unión conserva la suma de áreas; si no, se usa la unión general
+        if not union.is_valid or not np.isclose(union.area, areas[mayor].sum(), rtol=1e-9):
+            raise ValueError("la capa no es una cobertura")
+    except Exception:
+        union = shapely.union_all(geometrias[mayor])
+    if union.geom_type == 'MultiPolygon':
+        union = max(union.geoms, key=lambda p: p.area)
+    return union
+
+FORMATOS_PLANTACION = ['zip', 'kml', 'kmz', 'geojson', 'json', 'gpkg', 'parquet', 'geoparquet']
+
+def _shapefile_desde_zip(contenido):
+    """
+    ZIP en memoria con el primer shapefile del original en la raíz (GDAL no
+    lo reconoce dentro de subcarpetas). Los miembros se copian sin comprimir.
+    """
+    with zipfile.ZipFile(io.BytesIO(contenido), 'r') as original:
+        nombres = [n for n in original.namelist() if not n.startswith('__MACOSX')]
+        shp = [n for n in nombres if n.lower().endswith('.shp')]
+        if not shp:
+            return None
+        base = os.path.splitext(shp[0])[0]
+        salida = io.BytesIO()
+        with zipfile.ZipFile(salida, 'w', zipfile.ZIP_STORED) as plano:
+            for nombre in nombres:
+                raiz, ext = os.path.splitext(nombre)
+                if raiz == base:
+                    plano.writestr('capa' + ext.lower(), original.read(nombre))
+    return salida.getvalue()
+
+def leer_capa_vectorial(contenido, ext):
+    """
+    (GeoDataFrame, motor) leído directamente de los bytes subidos: GDAL abre el
+    buffer en /vsimem (y /vsizip para los ZIP) y pyogrio entrega las columnas
+    vía Arrow. GeoParquet se lee con pyarrow. None si el ZIP no trae shapefile.
+    """
+    if ext in ('.parquet', '.geoparquet'):
+        return gpd.read_parquet(io.BytesIO(contenido)), "GeoParquet (Arrow)"
+    if ext == '.zip':
+        contenido = _shapefile_desde_zip(contenido)
+        if contenido is None:
+            return None, None
+    if not PYOGRIO_OK:
+        return gpd.read_file(io.BytesIO(contenido)), "geopandas"
+    capa = None
+    if ext == '.gpkg':
+        # Un GeoPackage puede traer varias capas: se toma la primera poligonal
+        poligonales = [n for n, tipo in pyogrio.list_layers(io.BytesIO(contenido)) if tipo and 'Polygon' in tipo]
+        capa = poligonales[0] if poligonales else None
+    gdf = pyogrio.read_dataframe(io.BytesIO(contenido), layer=capa, use_arrow=ARROW_OK)
+    return gdf, "pyogrio + Arrow" if ARROW_OK else "pyogrio"
+
 def cargar_archivo_plantacion(uploaded_file):
     try:
         file_content = uploaded_file.read()
         ext = os.path.splitext(uploaded_file.name)[1].lower()
         gdf = None
+        t0 = time.time()
         
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            if ext == '.zip':
-                with zipfile.ZipFile(io.BytesIO(file_content), 'r') as zip_ref:
-                    zip_ref.extractall(tmp_dir)
-                shp_files = [f for f in os.listdir(tmp_dir) if f.endswith('.shp')]
-                if not shp_files:
-                    st.error("❌ No se encontró archivo .shp dentro del ZIP")
-                    return None
-                gdf = gpd.read_file(os.path.join(tmp_dir, shp_files[0]))
-            
-            elif ext == '.geojson':
-                gdf = gpd.read_file(io.BytesIO(file_content))
-            
-            elif ext == '.kml':
-                gdf = procesar_kml_robusto(file_content)
-                if gdf is None:
-                    st.error("❌ No se pudieron extraer polígonos del KML")
-                    return None
-            
-            elif ext == '.kmz':
-                kmz_path = os.path.join(tmp_dir, 'temp.kmz')
-                with open(kmz_path, 'wb') as f:
-                    f.write(file_content)
-                with zipfile.ZipFile(kmz_path, 'r') as kmz:
-                    kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-                    if not kml_files:
-                        st.error("❌ No se encontró KML dentro del KMZ")
-                        return None
-                    kmz.extract(kml_files[0], tmp_dir)
-                    with open(os.path.join(tmp_dir, kml_files[0]), 'rb') as f:
-                        gdf = procesar_kml_robusto(f.read())
-                if gdf is None:
-                    st.error("❌ No se pudieron extraer polígonos del KMZ")
+        if ext == '.kml':
+            gdf, motor = procesar_kml_robusto(file_content), "iterparse KML"
+            if gdf is None:
+                st.error("❌ No se pudieron extraer polígonos del KML")
+                return None
+        
+        elif ext == '.kmz':
+            # El KML se descomprime en streaming desde el ZIP en memoria
+            with zipfile.ZipFile(io.BytesIO(file_content), 'r') as kmz:
+                kml_files = [f for f in kmz.namelist() if f.lower().endswith('.kml')]
+                if not kml_files:
+                    st.error("❌ No se encontró KML dentro del KMZ")
                     return None
-            else:
-                st.error(f"❌ Formato no soportado: {ext}. Use .zip, .geojson, .kml o .kmz")
+                principal = 'doc.kml' if 'doc.kml' in kml_files else kml_files[0]
+                with kmz.open(principal) as f:
+                    gdf, motor = procesar_kml_robusto(f), "iterparse KML"
+            if gdf is None:
+                st.error("❌ No se pudieron extraer polígonos del KMZ")
+                return None
+        
+        elif ext.lstrip('.') in FORMATOS_PLANTACION:
+            gdf, motor = leer_capa_vectorial(file_content, ext)
+            if gdf is None:
+                st.error("❌ No se encontró archivo .shp dentro del ZIP")
                 return None
+        else:
+            st.error(f"❌ Formato no soportado: {ext}. Use .zip, .geojson, .kml, .kmz, .gpkg o .parquet")
+            return None
+        t_lectura = max(time.time() - t0, 1e-6)
         
         if gdf is None or len(gdf) == 0:
             st.error("❌ No se encontraron geometrías válidas")
             return None
         
         gdf = validar_y_corregir_crs(gdf)
-        gdf = gdf.explode(ignore_index=True)
-        gdf = gdf[gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])]
-        
-        if len(gdf) == 0:
+        lotes = preparar_lotes(gdf)
+        if lotes is None:
             st.error("❌ No hay polígonos válidos después del filtrado")
             return None
         
-        union = gdf.unary_union
-        if union.geom_type == 'MultiPolygon':
-            areas = [p.area for p in union.geoms]
-            main_poly = union.geoms[np.argmax(areas)]
-        else:
-            main_poly = union
+        main_poly = poligono_principal(np.asarray(lotes.geometry))
         
         if not main_poly.is_valid:
             try:
@@ -357,8 +579,15 @@ def cargar_archivo_plantacion(uploaded_file):
         st.session_state.archivo_cargado = True
         st.session_state.analisis_completado = False
         st.session_state.deteccion_ejecutada = False
+        st.session_state.lotes = lotes if lotes is not None and len(lotes) > 1 else None
+        st.session_state.resultados_lotes = None
         
         st.success(f"✅ Plantación cargada: {area:.2f} ha")
+        st.caption(f"⚡ {len(gdf)} entidades leídas en {t_lectura:.2f} s ({len(gdf) / t_lectura:,.0f} entidades/s, "
+                   f"{motor}); carga completa en {time.time() - t0:.2f} s")
+        if st.session_state.lotes is not None:
+            st.info(f"📦 El archivo contiene {len(lotes)} lotes. El análisis individual usa el polígono "
+                    "principal; el análisis por lotes procesa todos con sus atributos.")
         return gdf_unido
         
     except Exception as e:
@@ -367,14 +596,915 @@ def cargar_archivo_plantacion(uploaded_file):
         st.code(traceback.format_exc())
         return None
 
+# ===== CACHÉ LOCAL DE GRÁNULOS MODIS =====
+# Los HDF de MOD13Q1/MOD09A1 pesan decenas de MB; se guardan en disco
+# indexados por GranuleUR para que los re-análisis no vuelvan a descargarlos.
+CACHE_GRANULOS_DIR = os.environ.get(
+    "MODIS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "palma_modis_cache")
+)
+CACHE_GRANULOS_MAX_BYTES = int(float(os.environ.get("MODIS_CACHE_MAX_GB", "5")) * 1024 ** 3)
+FIRMA_HDF4 = b'\x0e\x03\x13\x01'
+N_LOCKS_GRANULOS = 64
+
+@contextmanager
+def conexion_sqlite(ruta):
+    """Conexión SQLite que confirma la transacción al salir sin error y siempre se cierra."""
+    con = sqlite3.connect(ruta)
+    try:
+        with con:
+            yield con
+    finally:
+        con.close()
+
+@st.cache_resource
+def _estado_cache_granulos():
+    """Índice SQLite y contadores compartidos por todas las sesiones."""
+    os.makedirs(CACHE_GRANULOS_DIR, exist_ok=True)
+    ruta_indice = os.path.join(CACHE_GRANULOS_DIR, 'indice.sqlite')
+    with conexion_sqlite(ruta_indice) as con:
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS granulos (
+                granule_ur TEXT PRIMARY KEY,
+                archivo TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                ultimo_acceso REAL NOT NULL
+            )
+        """)
+    # Locks por franjas de GranuleUR: un número fijo aunque el proceso viva semanas
+    return {'indice': ruta_indice, 'lock': threading.Lock(), 'aciertos': 0, 'fallos': 0,
+            'locks_granulo': [threading.Lock() for _ in range(N_LOCKS_GRANULOS)]}
+
+def _ruta_granulo_cache(granule_ur):
+    clave = hashlib.sha256(granule_ur.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_GRANULOS_DIR, clave[:2], f"{clave}.hdf")
+
+def _sha256_archivo(ruta, bloque=1024 * 1024):
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for chunk in iter(lambda: f.read(bloque), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _es_hdf4_valido(ruta):
+    """Reemplaza la heurística de 'página HTML': un HDF4 empieza con su firma."""
+    try:
+        if os.path.getsize(ruta) < 10240:
+            return False
+        with open(ruta, 'rb') as f:
+            return f.read(4) == FIRMA_HDF4
+    except OSError:
+        return False
+
+def _granulo_integro(ruta, fila):
+    """Tamaño y mtime deben coincidir con el índice; si no, se recalcula el SHA-256."""
+    if not os.path.exists(ruta) or not _es_hdf4_valido(ruta):
+        return False
+    _, _, tamano, mtime_ns, sha256, _ = fila
+    st_archivo = os.stat(ruta)
+    if st_archivo.st_size == tamano and st_archivo.st_mtime_ns == mtime_ns:
+        return True
+    return st_archivo.st_size == tamano and _sha256_archivo(ruta) == sha256
+
+def _desalojar_granulos_lru(con, max_bytes):
+    filas = con.execute(
+        "SELECT granule_ur, archivo, bytes FROM granulos ORDER BY ultimo_acceso ASC"
+    ).fetchall()
+    total = sum(f[2] for f in filas)
+    for granule_ur, archivo, tamano in filas:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(archivo)
+        except OSError:
+            pass
+        con.execute("DELETE FROM granulos WHERE granule_ur = ?", (granule_ur,))
+        total -= tamano
+
+def obtener_granulo_cacheado(granule, progreso=None):
+    """
+    Devuelve la ruta local del HDF del gránulo, descargándolo solo si no está
+    en caché o si falla la verificación de integridad. Lanza RuntimeError si
+    la descarga no produce un HDF4 válido.
+    """
+    estado = _estado_cache_granulos()
+    granule_ur = granule['umm']['GranuleUR']
+    ruta = _ruta_granulo_cache(granule_ur)
+
+    lock_granulo = estado['locks_granulo'][hash(granule_ur) % N_LOCKS_GRANULOS]
+
+    # Un solo hilo por gránulo: otra sesión puede estar escribiendo el mismo .part.
+    # El lock global solo protege el índice; verificar y calcular hashes se hace fuera de él
+    with lock_granulo:
+        with estado['lock'], conexion_sqlite(estado['indice']) as con:
+            fila = con.execute("SELECT * FROM granulos WHERE granule_ur = ?", (granule_ur,)).fetchone()
+        integro = fila is not None and _granulo_integro(ruta, fila)
+        with estado['lock'], conexion_sqlite(estado['indice']) as con:
+            if integro:
+                con.execute("UPDATE granulos SET ultimo_acceso = ? WHERE granule_ur = ?",
+                            (time.time(), granule_ur))
+                estado['aciertos'] += 1
+                return ruta
+            if fila is not None:
+                con.execute("DELETE FROM granulos WHERE granule_ur = ?", (granule_ur,))
+            estado['fallos'] += 1
+
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        if url_descarga_granulo(granule):
+            # El SHA-256 sale de la misma pasada que la descarga
+            sha256 = descargar_granulo_reanudable(granule, ruta, progreso)
+        else:
+            # Sin enlace HTTPS (p. ej. solo acceso S3): se delega en earthaccess
+            tmp_dir = tempfile.mkdtemp(dir=CACHE_GRANULOS_DIR)
+            try:
+                descargados = earthaccess.download(granule, local_path=tmp_dir) or []
+                hdf_files = [f for f in descargados if str(f).endswith('.hdf')]
+                if not hdf_files:
+                    raise RuntimeError(f"No se descargó ningún HDF para {granule_ur}")
+                if not _es_hdf4_valido(hdf_files[0]):
+                    raise RuntimeError("El archivo descargado no es un HDF4 válido (¿página HTML de error?)")
+                os.replace(hdf_files[0], ruta)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            sha256 = _sha256_archivo(ruta)
+
+        st_archivo = os.stat(ruta)
+        with estado['lock'], conexion_sqlite(estado['indice']) as con:
+            con.execute(
+                "INSERT OR REPLACE INTO granulos VALUES (?, ?, ?, ?, ?, ?)",
+                (granule_ur, ruta, st_archivo.st_size, st_archivo.st_mtime_ns, sha256, time.time())
+            )
+            _desalojar_granulos_lru(con, CACHE_GRANULOS_MAX_BYTES)
+    return ruta
+
+def estadisticas_cache_granulos():
+    estado = _estado_cache_granulos()
+    with estado['lock'], conexion_sqlite(estado['indice']) as con:
+        n_archivos, total_bytes = con.execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM granulos"
+        ).fetchone()
+    return {
+        'aciertos': estado['aciertos'],
+        'fallos': estado['fallos'],
+        'archivos': n_archivos,
+        'mb': total_bytes / 1024 ** 2,
+        'max_mb': CACHE_GRANULOS_MAX_BYTES / 1024 ** 2
+    }
+
+# ===== DESCARGA REANUDABLE DE GRÁNULOS =====
+# Descarga por HTTPS en bloques con reanudación por Range sobre un archivo .part,
+# límite global de descargas simultáneas y verificación del checksum publicado en CMR.
+MAX_DESCARGAS_SIMULTANEAS = int(os.environ.get("MODIS_MAX_DESCARGAS", "3"))
+BLOQUE_DESCARGA = 1024 * 1024
+REINTENTOS_DESCARGA = 5
+
+@st.cache_resource
+def _limite_descargas():
+    """Semáforo compartido por todas las sesiones para no saturar el servidor de la DAAC."""
+    return threading.BoundedSemaphore(MAX_DESCARGAS_SIMULTANEAS)
+
+_sesiones_hilo = threading.local()
+
+def _sesion_https():
+    """Una sesión autenticada de earthaccess por hilo (requests.Session no es thread-safe)."""
+    if getattr(_sesiones_hilo, 'sesion', None) is None:
+        _sesiones_hilo.sesion = earthaccess.get_requests_https_session()
+    return _sesiones_hilo.sesion
+
+def url_descarga_granulo(granule):
+    for url in granule['umm'].get('RelatedUrls', []):
+        enlace = url.get('URL', '')
+        if url.get('Type') == 'GET DATA' and enlace.startswith('https') and enlace.endswith('.hdf'):
+            return enlace
+    return None
+
+def info_archivo_granulo(granule, nombre):
+    """
+    (tamaño en bytes, algoritmo, checksum) del archivo según el UMM del gránulo.
+    Size/SizeUnit es aproximado, así que solo se usa SizeInBytes; si no está,
+    el tamaño sale del Content-Length de la respuesta.
+    """
+    archivos = granule['umm'].get('DataGranule', {}).get('ArchiveAndDistributionInformation', [])
+    for archivo in archivos:
+        if archivo.get('Name') != nombre:
+            continue
+        tamano = archivo.get('SizeInBytes')
+        checksum = archivo.get('Checksum') or {}
+        algoritmo = checksum.get('Algorithm', '').lower().replace('-', '')
+        return (int(tamano) if tamano else None,
+                algoritmo if algoritmo in hashlib.algorithms_available else None,
+                checksum.get('Value'))
+    return None, None, None
+
+def _digestores(algoritmos, ruta=None):
+    """Hashes incrementales de cada algoritmo; si se da `ruta`, ya alimentados con su contenido."""
+    digestores = {a: hashlib.new(a) for a in algoritmos}
+    if ruta is not None:
+        with open(ruta, 'rb') as f:
+            for chunk in iter(lambda: f.read(BLOQUE_DESCARGA), b''):
+                for h in digestores.values():
+                    h.update(chunk)
+    return digestores
+
+def descargar_granulo_reanudable(granule, destino, progreso=None):
+    """
+    Descarga el HDF del gránulo en `destino`. Si la conexión se corta, el
+    siguiente intento (o el siguiente análisis) continúa desde los bytes ya
+    escritos en `destino + '.part'`. `progreso` es un dict compartido
+    {GranuleUR: (recibidos, total)} que lee el hilo principal. El SHA-256 y
+    el checksum de CMR se calculan mientras llegan los bloques; devuelve el SHA-256.
+    """
+    granule_ur = granule['umm']['GranuleUR']
+    url = url_descarga_granulo(granule)
+    total, algoritmo, checksum = info_archivo_granulo(granule, url.rsplit('/', 1)[-1])
+    parcial = destino + '.part'
+    algoritmos = {'sha256'} | ({algoritmo} if algoritmo and checksum else set())
+    digestores, hasheados = None, 0
+
+    for intento in range(REINTENTOS_DESCARGA):
+        recibidos = os.path.getsize(parcial) if os.path.exists(parcial) else 0
+        if total is not None and recibidos > total:
+            os.remove(parcial)
+            recibidos = 0
+        if progreso is not None:
+            progreso[granule_ur] = (recibidos, total)
+        if total is not None and recibidos == total:
+            break
+        cabeceras = {'Range': f'bytes={recibidos}-'} if recibidos else {}
+        try:
+            with _limite_descargas():
+                with _sesion_https().get(url, headers=cabeceras, stream=True, timeout=(10, 60)) as r:
+                    if r.status_code == 416:
+                        break
+                    r.raise_for_status()
+                    if r.status_code == 200 and recibidos:
+                        recibidos = 0  # el servidor ignoró el Range
+                    if total is None and r.headers.get('Content-Length'):
+                        total = recibidos + int(r.headers['Content-Length'])
+                    # Al reanudar, los bytes ya escritos por otro intento o análisis se hashean una vez
+                    if not recibidos:
+                        digestores, hasheados = _digestores(algoritmos), 0
+                    elif digestores is None or hasheados != recibidos:
+                        digestores, hasheados = _digestores(algoritmos, parcial), recibidos
+                    with open(parcial, 'ab' if recibidos else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=BLOQUE_DESCARGA):
+                            f.write(chunk)
+                            for h in digestores.values():
+                                h.update(chunk)
+                            hasheados += len(chunk)
+                            recibidos += len(chunk)
+                            if progreso is not None:
+                                progreso[granule_ur] = (recibidos, total)
+            if total is None or recibidos >= total:
+                break
+        except requests.RequestException as e:
+            if intento == REINTENTOS_DESCARGA - 1:
+                raise RuntimeError(f"Descarga interrumpida tras {REINTENTOS_DESCARGA} intentos: {e}")
+            time.sleep(2 ** intento)
+    else:
+        raise RuntimeError(f"Descarga incompleta de {granule_ur}")
+
+    if not _es_hdf4_valido(parcial):
+        os.remove(parcial)
+        raise RuntimeError("El archivo descargado no es un HDF4 válido (¿página HTML de error?)")
+    if digestores is None or hasheados != os.path.getsize(parcial):
+        digestores = _digestores(algoritmos, parcial)  # .part ya completo de un análisis anterior
+    if algoritmo and checksum and digestores[algoritmo].hexdigest().lower() != checksum.lower():
+        os.remove(parcial)
+        raise RuntimeError(f"Checksum {algoritmo.upper()} no coincide para {granule_ur}")
+    os.replace(parcial, destino)
+    return digestores['sha256'].hexdigest()
+
+# ===== LECTURA POR VENTANA DE TESELAS MODIS =====
+PROJ4_SINUSOIDAL_MODIS = "+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 +b=6371007.181 +units=m +no_defs"
+
+# Rejilla sinusoidal global MODIS: 36 x 18 teselas de 10° (1111950.52 m de lado)
+TAMANO_TESELA_MODIS = 1111950.5196666666
+X_MIN_MODIS = -20015109.354
+Y_MAX_MODIS = 10007554.677
+N_TESELAS_H, N_TESELAS_V = 36, 18
+PIXELES_POR_TESELA = {250: 4800, 500: 2400, 1000: 1200}
+
+def transform_tesela_modis(h, v, n_pixeles):
+    """Transformación afín exacta de la tesela hXXvYY para una rejilla de n_pixeles por lado."""
+    if n_pixeles not in PIXELES_POR_TESELA.values():
+        raise ValueError(f"Tamaño de tesela MODIS no reconocido: {n_pixeles} píxeles")
+    res = TAMANO_TESELA_MODIS / n_pixeles
+    return rasterio.Affine(res, 0, X_MIN_MODIS + h * TAMANO_TESELA_MODIS,
+                           0, -res, Y_MAX_MODIS - v * TAMANO_TESELA_MODIS)
+
+def teselas_para_bounds(bounds):
+    """Teselas (h, v) que cubren unos límites en metros sinusoidales, sin abrir ningún archivo."""
+    minx, miny, maxx, maxy = bounds
+    h0 = int(math.floor((minx - X_MIN_MODIS) / TAMANO_TESELA_MODIS))
+    h1 = int(math.ceil((maxx - X_MIN_MODIS) / TAMANO_TESELA_MODIS)) - 1
+    v0 = int(math.floor((Y_MAX_MODIS - maxy) / TAMANO_TESELA_MODIS))
+    v1 = int(math.ceil((Y_MAX_MODIS - miny) / TAMANO_TESELA_MODIS)) - 1
+    h0, h1 = max(h0, 0), min(max(h1, h0), N_TESELAS_H - 1)
+    v0, v1 = max(v0, 0), min(max(v1, v0), N_TESELAS_V - 1)
+    return [(h, v) for v in range(v0, v1 + 1) for h in range(h0, h1 + 1)]
+
+def tesela_granulo(granule):
+    """(h, v) del gránulo según la convención de nombres MODIS (...hHHvVV...)."""
+    m = re.search(r'\.h(\d{2})v(\d{2})\.', granule['umm']['GranuleUR'])
+    if not m:
+        raise ValueError(f"GranuleUR sin tesela h/v: {granule['umm']['GranuleUR']}")
+    return int(m.group(1)), int(m.group(2))
+
+def georreferencia_tesela(hdf, nombre, tesela):
+    """Transformación y forma del SDS a partir de la rejilla global; falla si la forma no cuadra."""
+    forma = tuple(hdf.select(nombre).info()[2])
+    if len(forma) != 2 or forma[0] != forma[1]:
+        raise ValueError(f"El dataset {nombre} no es una tesela MODIS cuadrada: {forma}")
+    return transform_tesela_modis(tesela[0], tesela[1], forma[0]), forma
+
+def filtrar_granulos_por_teselas(granulos, gdf_proj):
+    """Descarta gránulos de teselas que no tocan la plantación (el bbox geográfico es más amplio)."""
+    teselas = set(teselas_para_bounds(gdf_proj.total_bounds))
+    filtrados = []
+    for granule in granulos:
+        try:
+            if tesela_granulo(granule) in teselas:
+                filtrados.append(granule)
+        except ValueError:
+            continue
+    return filtrados
+
+def calcular_ventana_pixeles(bounds, transform, forma, margen=1):
+    """
+    Convierte límites (minx, miny, maxx, maxy) en el CRS de la tesela a una
+    ventana (fila0, col0, n_filas, n_cols) recortada a la tesela. None si no se solapan.
+    """
+    minx, miny, maxx, maxy = bounds
+    col0 = int(math.floor((minx - transform.c) / transform.a)) - margen
+    col1 = int(math.ceil((maxx - transform.c) / transform.a)) + margen
+    fila0 = int(math.floor((maxy - transform.f) / transform.e)) - margen
+    fila1 = int(math.ceil((miny - transform.f) / transform.e)) + margen
+    fila0, col0 = max(fila0, 0), max(col0, 0)
+    fila1, col1 = min(fila1, forma[0]), min(col1, forma[1])
+    if fila1 <= fila0 or col1 <= col0:
+        return None
+    return fila0, col0, fila1 - fila0, col1 - col0
+
+def leer_ventana_sds(hdf, nombre, ventana, transform):
+    """Lee solo la ventana pedida del SDS (start/count de pyhdf) y su transformación."""
+    fila0, col0, n_filas, n_cols = ventana
+    datos = hdf.select(nombre).get(start=(fila0, col0), count=(n_filas, n_cols))
+    return datos, transform * rasterio.Affine.translation(col0, fila0)
+
+# ===== ESTADÍSTICAS ZONALES VECTORIZADAS =====
+PERCENTILES_ZONALES = (10, 50, 90)
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _pesos_cobertura(clave, _geometrias, transform_tuple, forma):
+    """Matriz dispersa (n_bloques x n_píxeles) con la fracción de cada píxel cubierta por cada bloque."""
+    from scipy import sparse
+    transform = rasterio.Affine(*transform_tuple)
+    alto, ancho = forma
+    res_x, res_y = transform.a, -transform.e
+    filas_z, cols_p, fracciones = [], [], []
+    for i, geom in enumerate(_geometrias):
+        if geom is None or geom.is_empty:
+            continue
+        minx, miny, maxx, maxy = geom.bounds
+        c0 = max(int(np.floor((minx - transform.c) / res_x)), 0)
+        c1 = min(int(np.ceil((maxx - transform.c) / res_x)), ancho)
+        f0 = max(int(np.floor((transform.f - maxy) / res_y)), 0)
+        f1 = min(int(np.ceil((transform.f - miny) / res_y)), alto)
+        if c1 <= c0 or f1 <= f0:
+            continue
+        ff, cc = np.mgrid[f0:f1, c0:c1]
+        ff, cc = ff.ravel(), cc.ravel()
+        x0 = transform.c + cc * res_x
+        y1 = transform.f - ff * res_y
+        cajas = shapely.box(x0, y1 - res_y, x0 + res_x, y1)
+        fraccion = shapely.area(shapely.intersection(geom, cajas)) / (res_x * res_y)
+        dentro = fraccion > 1e-9
+        filas_z.append(np.full(dentro.sum(), i))
+        cols_p.append(ff[dentro] * ancho + cc[dentro])
+        fracciones.append(fraccion[dentro])
+    if not fracciones:
+        return sparse.csr_matrix((len(_geometrias), alto * ancho))
+    return sparse.csr_matrix(
+        (np.concatenate(fracciones), (np.concatenate(filas_z), np.concatenate(cols_p))),
+        shape=(len(_geometrias), alto * ancho)
+    )
+
+def matriz_pesos_cobertura(gdf_proj, transform, forma):
+    """
+    Pesos de cobertura exactos por área, calculados una vez por par
+    (distribución de bloques, rejilla) y reutilizados por todos los índices y fechas.
+    """
+    geometrias = np.asarray(gdf_proj.geometry)
+    clave = hashlib.sha1(b''.join(shapely.to_wkb(geometrias))).hexdigest()
+    return _pesos_cobertura(clave, geometrias, tuple(transform)[:6], tuple(forma))
+
+def estadisticas_zonales(valores, pesos, percentiles=PERCENTILES_ZONALES):
+    """
+    Media y desviación ponderadas por cobertura, píxeles equivalentes y
+    percentiles ponderados por zona. Los NaN de `valores` se ignoran.
+    """
+    v = np.asarray(valores, dtype=np.float64).ravel()
+    valido = np.isfinite(v)
+    v0 = np.where(valido, v, 0.0)
+    peso = pesos @ valido.astype(np.float64)
+    suma = pesos @ v0
+    suma2 = pesos @ (v0 * v0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        media = np.where(peso > 0, suma / peso, np.nan)
+        std = np.sqrt(np.maximum(suma2 / peso - media ** 2, 0.0))
+
+    stats = {'media': media, 'n_pixeles': peso, 'std': std}
+    if percentiles:
+        coo = pesos.tocoo()
+        ok = valido[coo.col]
+        z, val, w = coo.row[ok], v[coo.col[ok]], coo.data[ok]
+        orden = np.lexsort((val, z))
+        val, w = val[orden], w[orden]
+        acumulado = np.cumsum(w)
+        n_z = np.bincount(z, minlength=pesos.shape[0])
+        ini_n = np.concatenate(([0], np.cumsum(n_z)[:-1]))
+        ini_w = np.concatenate(([0.0], acumulado))[ini_n]
+        for p in percentiles:
+            pos = np.searchsorted(acumulado, ini_w + peso * (p / 100.0), side='left')
+            pos = np.clip(pos, ini_n, ini_n + n_z - 1).clip(0, max(len(val) - 1, 0))
+            stats[f'p{p}'] = np.where(peso > 0, val[pos] if len(val) else np.nan, np.nan)
+    return pd.DataFrame(stats)
+
+def asignar_indice_por_bloques(gdf_dividido, columna, valores, pesos, extras=None):
+    """Escribe la media zonal en `columna` y, si se pasa `extras`, guarda allí las estadísticas completas."""
+    stats = estadisticas_zonales(valores, pesos)
+    stats.index = gdf_dividido.index
+    gdf_dividido[columna] = stats['media'].round(3)
+    if extras is not None:
+        extras.setdefault('estadisticas_zonales', {})[columna] = stats
+    return stats
+
+# ===== SERIES TEMPORALES MULTI-GRÁNULO =====
+MAX_HILOS_GRANULOS = 4
+
+def _pool_con_contexto(max_workers):
+    """ThreadPoolExecutor cuyos hilos heredan el contexto de Streamlit de la sesión actual."""
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    )
+
+def fecha_granulo(granule):
+    """Fecha de adquisición del gránulo (AYYYYDDD del GranuleUR o TemporalExtent)."""
+    umm = granule['umm']
+    m = re.search(r'\.A(\d{7})\.', umm.get('GranuleUR', ''))
+    if m:
+        return datetime.strptime(m.group(1), '%Y%j')
+    inicio = umm.get('TemporalExtent', {}).get('RangeDateTime', {}).get('BeginningDateTime', '')
+    return datetime.strptime(inicio[:10], '%Y-%m-%d')
+
+def ventana_global_modis(gdf_proj, res):
+    """Ventana de la plantación en la rejilla sinusoidal global (todas las teselas) a resolución `res`."""
+    n = int(round(TAMANO_TESELA_MODIS / res))
+    transform_global = rasterio.Affine(res, 0, X_MIN_MODIS, 0, -res, Y_MAX_MODIS)
+    ventana = calcular_ventana_pixeles(gdf_proj.total_bounds, transform_global,
+                                       (N_TESELAS_V * n, N_TESELAS_H * n))
+    if ventana is None:
+        raise ValueError("La plantación queda fuera de la rejilla MODIS.")
+    fila0, col0, _, _ = ventana
+    return ventana, transform_global * rasterio.Affine.translation(col0, fila0)
+
+def construir_mosaicos(resultados, gdf_proj):
+    """
+    Cose, fecha a fecha, las ventanas leídas de cada tesela en un único
+    mosaico en memoria alineado a la rejilla global. Devuelve fechas, pilas
+    {columna: (n_fechas, filas, cols)}, transform y avisos.
+    """
+    avisos = []
+    resoluciones = [round(t.a, 6) for _, _, t in resultados]
+    res = max(set(resoluciones), key=resoluciones.count)
+    if resoluciones.count(res) < len(resultados):
+        avisos.append(f"{len(resultados) - resoluciones.count(res)} gránulo(s) con otra resolución omitidos")
+    (_, _, n_filas, n_cols), transform = ventana_global_modis(gdf_proj, res)
+    columnas = list(resultados[0][1].keys())
+
+    por_fecha = {}
+    for fecha, capas, t in resultados:
+        if round(t.a, 6) == res:
+            por_fecha.setdefault(fecha, []).append((capas, t))
+
+    fechas = sorted(por_fecha)
+    pilas = {col: np.full((len(fechas), n_filas, n_cols), np.nan, dtype=np.float32) for col in columnas}
+    for i, fecha in enumerate(fechas):
+        for capas, t in por_fecha[fecha]:
+            # Desplazamiento de la ventana de la tesela dentro del mosaico
+            f0 = int(round((t.f - transform.f) / transform.e))
+            c0 = int(round((t.c - transform.c) / transform.a))
+            alto, ancho = next(iter(capas.values())).shape
+            df0, dc0 = max(f0, 0), max(c0, 0)
+            df1, dc1 = min(f0 + alto, n_filas), min(c0 + ancho, n_cols)
+            if df1 <= df0 or dc1 <= dc0:
+                continue
+            for col in columnas:
+                origen = capas[col][df0 - f0:df1 - f0, dc0 - c0:dc1 - c0]
+                destino = pilas[col][i, df0:df1, dc0:dc1]
+                np.copyto(destino, origen, where=np.isnan(destino))
+    return fechas, pilas, transform, avisos
+
+def procesar_serie_granulos(granulos, gdf_proj, extraer, texto):
+    """
+    Descarga (vía caché), decodifica la ventana y extrae las capas de cada
+    gránulo en un pool de hilos. `extraer(ruta_hdf, gdf_proj, tesela)` devuelve
+    ({columna: array_2d}, transform). Las teselas de una misma fecha se cosen
+    en un mosaico y se apilan por fecha en arrays (n_fechas, filas, cols).
+    """
+    _estado_cache_granulos()  # inicializa el índice en el hilo principal
+    _limite_descargas()
+    progreso = {}
+
+    def tarea(granule):
+        tesela = tesela_granulo(granule)
+        ruta = obtener_granulo_cacheado(granule, progreso)
+        capas, transform = extraer(ruta, gdf_proj, tesela)
+        return fecha_granulo(granule), capas, transform
+
+    resultados, errores, procesados = [], [], []
+    t0 = time.time()
+    progress_bar = st.progress(0, text=texto)
+    with _pool_con_contexto(MAX_HILOS_GRANULOS) as pool:
+        futuros = {pool.submit(tarea, g): g['umm']['GranuleUR'] for g in granulos}
+        pendientes = set(futuros)
+        while pendientes:
+            hechos, pendientes = wait(pendientes, timeout=0.5, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                try:
+                    resultados.append(futuro.result())
+                    procesados.append(futuros[futuro])
+                except Exception as e:
+                    errores.append(f"{futuros[futuro]}: {str(e)[:100]}")
+            n_hechos = len(futuros) - len(pendientes)
+            # Los gránulos en descarga aportan su fracción de bytes recibidos
+            instantanea = dict(progreso)
+            urs_pendientes = {futuros[f] for f in pendientes}
+            en_curso = [(r, t) for ur, (r, t) in instantanea.items() if t and ur in urs_pendientes]
+            fraccion = (n_hechos + sum(r / t for r, t in en_curso)) / len(futuros)
+            mb = sum(r for r, _ in instantanea.values()) / 1024 ** 2
+            texto_bytes = f" · {mb:.1f} MB descargados" if mb else ""
+            progress_bar.progress(min(fraccion, 1.0),
+                                  text=f"{texto} {n_hechos}/{len(futuros)}{texto_bytes}")
+    progress_bar.empty()
+    duracion = time.time() - t0
+
+    if not resultados:
+        return {'fechas': [], 'pilas': {}, 'transform': None, 'errores': errores, 'duracion': duracion,
+                'granulos_procesados': []}
+
+    fechas, pilas, transform, avisos = construir_mosaicos(resultados, gdf_proj)
+    return {
+        'fechas': fechas,
+        'pilas': pilas,
+        'transform': transform,
+        'errores': errores + avisos,
+        'duracion': duracion,
+        'n_granulos': len(granulos),
+        'n_procesados': len(resultados),
+        'granulos_procesados': procesados
+    }
+
+def medias_zonales_serie(pila, pesos):
+    """Media ponderada por zona y fecha (n_zonas x n_fechas) con un único producto disperso."""
+    n_fechas = pila.shape[0]
+    v = pila.reshape(n_fechas, -1).T.astype(np.float64)
+    valido = np.isfinite(v)
+    peso = pesos @ valido.astype(np.float64)
+    suma = pesos @ np.where(valido, v, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(peso > 0, suma / peso, np.nan)
+
+def aplicar_serie_a_bloques(gdf_dividido, gdf_proj, serie, extras=None):
+    """
+    Añade a gdf_dividido la media zonal de la mediana temporal de cada capa y
+    guarda la serie bloque x fecha en extras['series_temporales'].
+    """
+    primera = next(iter(serie['pilas'].values()))
+    pesos = matriz_pesos_cobertura(gdf_proj, serie['transform'], primera.shape[1:])
+    fechas = pd.DatetimeIndex(serie['fechas'])
+    for columna, pila in serie['pilas'].items():
+        medias = medias_zonales_serie(pila, pesos)
+        df_serie = pd.DataFrame(medias.round(3), index=gdf_dividido['id_bloque'].values, columns=fechas)
+        df_serie = df_serie.T.groupby(level=0).mean().T
+        if extras is not None:
+            extras.setdefault('series_temporales', {})[columna] = df_serie
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            compuesto = np.nanmedian(pila, axis=0)
+        asignar_indice_por_bloques(gdf_dividido, columna, compuesto, pesos, extras)
+    return gdf_dividido
+
+def informar_rendimiento_serie(serie, producto):
+    n_ok = serie.get('n_procesados', len(serie['fechas']))
+    duracion = max(serie['duracion'], 1e-6)
+    st.caption(f"⏱️ {producto}: {n_ok}/{serie.get('n_granulos', n_ok)} gránulos en {duracion:.1f} s "
+               f"({serie.get('n_granulos', n_ok) / duracion * 60:.1f} gránulos/min)")
+    for error in serie['errores'][:5]:
+        st.warning(f"Gránulo omitido — {error}")
+
+def _extraer_ndvi_mod13q1(ruta_hdf, gdf_proj, tesela):
+    hdf = SD(ruta_hdf, SDC.READ)
+    try:
+        ndvi_dataset = next((n for n in hdf.datasets().keys() if 'NDVI' in n), None)
+        if ndvi_dataset is None:
+            raise ValueError("No se encontró dataset NDVI en el archivo HDF.")
+        transform_tesela, forma_tesela = georreferencia_tesela(hdf, ndvi_dataset, tesela)
+        ventana = calcular_ventana_pixeles(gdf_proj.total_bounds, transform_tesela, forma_tesela)
+        if ventana is None:
+            raise ValueError("La plantación no intersecta la tesela MODIS descargada.")
+        ndvi_data, transform = leer_ventana_sds(hdf, ndvi_dataset, ventana, transform_tesela)
+    finally:
+        hdf.end()
+    # Rango válido MOD13Q1: -2000..10000 (relleno -3000), factor 0.0001
+    valido = (ndvi_data >= -2000) & (ndvi_data <= 10000)
+    return {'ndvi_modis': np.where(valido, ndvi_data.astype(np.float32) * 0.0001, np.nan)}, transform
+
+# ===== MOTOR DE ÍNDICES ESPECTRALES (MOD09) =====
+# Bandas de reflectancia MOD09A1/MOD09Q1 (sur_refl_b0N). Añadir un índice solo
+# requiere declarar su fórmula: las bandas se leen una vez por ventana.
+BANDAS_MOD09 = {'red': 1, 'nir': 2, 'blue': 3, 'green': 4, 'swir1': 6, 'swir2': 7}
+
+INDICES_ESPECTRALES = {
+    'ndwi_modis': {
+        'nombre': 'NDWI', 'bandas': ('nir', 'swir1'),
+        'formula': lambda b: (b['nir'] - b['swir1']) / (b['nir'] + b['swir1']),
+        'vmin': 0.1, 'vmax': 0.7, 'colores': ['brown', 'yellow', 'blue']
+    },
+    'ndvi_mod09': {
+        'nombre': 'NDVI (MOD09)', 'bandas': ('nir', 'red'),
+        'formula': lambda b: (b['nir'] - b['red']) / (b['nir'] + b['red']),
+        'vmin': 0.3, 'vmax': 0.9, 'colores': ['red', 'yellow', 'green']
+    },
+    'evi_modis': {
+        'nombre': 'EVI', 'bandas': ('nir', 'red', 'blue'),
+        'formula': lambda b: 2.5 * (b['nir'] - b['red']) / (b['nir'] + 6 * b['red'] - 7.5 * b['blue'] + 1),
+        'vmin': 0.2, 'vmax': 0.7, 'colores': ['red', 'yellow', 'green']
+    },
+    'savi_modis': {
+        'nombre': 'SAVI', 'bandas': ('nir', 'red'),
+        'formula': lambda b: 1.5 * (b['nir'] - b['red']) / (b['nir'] + b['red'] + 0.5),
+        'vmin': 0.2, 'vmax': 0.7, 'colores': ['red', 'yellow', 'green']
+    },
+    'gndvi_modis': {
+        'nombre': 'GNDVI', 'bandas': ('nir', 'green'),
+        'formula': lambda b: (b['nir'] - b['green']) / (b['nir'] + b['green']),
+        'vmin': 0.3, 'vmax': 0.8, 'colores': ['red', 'yellow', 'green']
+    },
+    'nbr_modis': {
+        'nombre': 'NBR', 'bandas': ('nir', 'swir2'),
+        'formula': lambda b: (b['nir'] - b['swir2']) / (b['nir'] + b['swir2']),
+        'vmin': 0.2, 'vmax': 0.8, 'colores': ['brown', 'yellow', 'green']
+    },
+}
+
+def _buscar_bandas_mod09(hdf):
+    """Nombre del dataset de cada banda (sur_refl_b0N en MOD09A1/MOD09Q1, sur_refl_b0N_1 en MOD09GA)."""
+    numeros = {v: k for k, v in BANDAS_MOD09.items()}
+    bandas = {}
+    for name in hdf.datasets().keys():
+        m = re.fullmatch(r'sur_refl_b0(\d)(_1)?', name, re.IGNORECASE)
+        if m and int(m.group(1)) in numeros:
+            bandas[numeros[int(m.group(1))]] = name
+    return bandas
+
+def evaluar_indices(reflectancias, validas, indices=None):
+    """
+    Evalúa en una pasada vectorizada todos los índices declarados cuyas bandas
+    estén disponibles. `validas` es la máscara por banda; cada índice usa el
+    AND de las máscaras de sus bandas.
+    """
+    resultado = {}
+    for columna, spec in INDICES_ESPECTRALES.items():
+        if indices is not None and columna not in indices:
+            continue
+        if not all(b in reflectancias for b in spec['bandas']):
+            continue
+        mascara = np.logical_and.reduce([validas[b] for b in spec['bandas']])
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            valores = spec['formula'](reflectancias)
+        resultado[columna] = np.where(mascara & np.isfinite(valores), valores, np.nan).astype(np.float32)
+    return resultado
+
+def _extraer_indices_mod09(ruta_hdf, gdf_proj, tesela, indices=None):
+    hdf = SD(ruta_hdf, SDC.READ)
+    try:
+        bandas = _buscar_bandas_mod09(hdf)
+        requeridas = {b for col, spec in INDICES_ESPECTRALES.items()
+                      if indices is None or col in indices
+                      for b in spec['bandas'] if all(x in bandas for x in spec['bandas'])}
+        if not requeridas:
+            raise ValueError(f"No se encontraron bandas de reflectancia. Datasets disponibles: {list(hdf.datasets().keys())[:10]}")
+        referencia = bandas['nir'] if 'nir' in requeridas else bandas[sorted(requeridas)[0]]
+        transform_tesela, forma_tesela = georreferencia_tesela(hdf, referencia, tesela)
+        ventana = calcular_ventana_pixeles(gdf_proj.total_bounds, transform_tesela, forma_tesela)
+        if ventana is None:
+            raise ValueError("La plantación no intersecta la tesela MODIS descargada.")
+        # Cada banda se lee una sola vez (ventana start/count) para todos los índices
+        reflectancias, validas = {}, {}
+        for banda in requeridas:
+            datos, transform = leer_ventana_sds(hdf, bandas[banda], ventana, transform_tesela)
+            validas[banda] = (datos >= -100) & (datos <= 16000)  # rango válido MOD09
+            reflectancias[banda] = datos.astype(np.float32) * 0.0001
+    finally:
+        hdf.end()
+    return evaluar_indices(reflectancias, validas, indices), transform
+
+# ===== CUBO LOCAL DE ÍNDICES POR PLANTACIÓN =====
+# Valores por píxel y fecha de la ventana de la plantación, en NetCDF. Los
+# re-análisis solo buscan gránulos posteriores a la última fecha guardada.
+CUBOS_DIR = os.environ.get("CUBOS_INDICES_DIR", os.path.join(CACHE_GRANULOS_DIR, 'cubos'))
+PIXELES_PRODUCTO = {'MOD13Q1': 4800, 'MOD09A1': 2400, 'MOD09Q1': 4800}
+DIAS_COMPUESTO = {'MOD13Q1': 16, 'MOD09A1': 8, 'MOD09Q1': 8}
+
+def ruta_cubo(short_name, ventana):
+    fila0, col0, n_filas, n_cols = ventana
+    return os.path.join(CUBOS_DIR, f"{short_name}_{PIXELES_PRODUCTO[short_name]}_{fila0}_{col0}_{n_filas}x{n_cols}.nc")
+
+def cargar_cubo(ruta, firma):
+    """Cubo guardado o None si no existe, está dañado o se creó con otras variables."""
+    if not os.path.exists(ruta):
+        return None
+    try:
+        with xr.open_dataset(ruta) as ds:
+            cubo = ds.load()
+    except Exception:
+        return None
+    return cubo if cubo.attrs.get('firma') == firma else None
+
+def guardar_cubo(cubo, ruta):
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    tmp = f"{ruta}.{threading.get_ident()}.tmp"
+    cubo.to_netcdf(tmp, encoding={v: {'zlib': True, 'complevel': 4} for v in cubo.data_vars})
+    os.replace(tmp, ruta)
+
+def _lista_attr(cubo, nombre):
+    """Lista guardada como JSON en los atributos del cubo (None si el cubo no la tiene)."""
+    if cubo is None or nombre not in cubo.attrs:
+        return None
+    return json.loads(cubo.attrs[nombre])
+
+def _dia(fecha):
+    return pd.Timestamp(fecha).normalize().to_pydatetime()
+
+def fusionar_intervalos(intervalos):
+    """Ordena y une los intervalos de días (desde, hasta) que se solapan o son contiguos."""
+    fusionados = []
+    for desde, hasta in sorted((_dia(d), _dia(h)) for d, h in intervalos):
+        if fusionados and desde <= fusionados[-1][1] + timedelta(days=1):
+            fusionados[-1] = (fusionados[-1][0], max(fusionados[-1][1], hasta))
+        else:
+            fusionados.append((desde, hasta))
+    return fusionados
+
+def intervalos_consultados(cubo):
+    """Intervalos ya buscados en CMR para el cubo (los cubos antiguos solo guardaban 'consultado_desde')."""
+    if cubo is None:
+        return []
+    if 'intervalos_consultados' in cubo.attrs:
+        return [(_dia(d), _dia(h)) for d, h in json.loads(cubo.attrs['intervalos_consultados'])]
+    if 'consultado_desde' in cubo.attrs and cubo.sizes['time']:
+        return [(_dia(cubo.attrs['consultado_desde']), _dia(cubo['time'].values.max()))]
+    return []
+
+def intervalos_pendientes(cubo, fecha_inicio, fecha_fin):
+    """
+    Tramos del rango pedido que el cubo aún no cubre: el complemento de los
+    intervalos ya consultados y cada fecha incompleta (gránulos buscados que
+    no llegaron a guardarse por un fallo de red o de autenticación).
+    """
+    inicio, fin = _dia(fecha_inicio), _dia(fecha_fin)
+    un_dia = timedelta(days=1)
+    pendientes, cursor = [], inicio
+    for desde, hasta in fusionar_intervalos(intervalos_consultados(cubo)):
+        if hasta < cursor:
+            continue
+        if desde > fin:
+            break
+        if desde > cursor:
+            pendientes.append((cursor, desde - un_dia))
+        cursor = hasta + un_dia
+    if cursor <= fin:
+        pendientes.append((cursor, fin))
+    for fecha in _lista_attr(cubo, 'fechas_incompletas') or []:
+        fecha = _dia(fecha)
+        if inicio <= fecha <= fin and not any(d <= fecha <= h for d, h in pendientes):
+            pendientes.append((fecha, fecha))
+    return pendientes
+
+def anexar_al_cubo(cubo, serie, transform, firma):
+    n_filas, n_cols = next(iter(serie['pilas'].values())).shape[1:]
+    x = transform.c + (np.arange(n_cols) + 0.5) * transform.a
+    y = transform.f + (np.arange(n_filas) + 0.5) * transform.e
+    nuevo = xr.Dataset(
+        {col: (('time', 'y', 'x'), pila) for col, pila in serie['pilas'].items()},
+        coords={'time': pd.DatetimeIndex(serie['fechas']), 'y': y, 'x': x}
+    )
+    if cubo is not None:
+        # Una fecha ya guardada con teselas que faltaban se completa píxel a píxel
+        nuevo = nuevo.combine_first(cubo)
+    nuevo.attrs = dict(cubo.attrs) if cubo is not None else {}
+    nuevo.attrs.update({'firma': firma, 'crs': PROJ4_SINUSOIDAL_MODIS, 'transform': list(transform)[:6]})
+    return nuevo
+
+def serie_desde_cubo(cubo, fecha_inicio, fecha_fin, transform, dias_compuesto=1):
+    # Un compuesto fechado antes del inicio sigue siendo válido si su período solapa el rango
+    desde = pd.Timestamp(fecha_inicio) - pd.Timedelta(days=dias_compuesto - 1)
+    tramo = cubo.sel(time=slice(desde, pd.Timestamp(fecha_fin)))
+    if tramo.sizes['time'] == 0:
+        return None
+    return {
+        'fechas': [pd.Timestamp(t).to_pydatetime() for t in tramo['time'].values],
+        'pilas': {col: tramo[col].values for col in tramo.data_vars},
+        'transform': transform,
+        'errores': [],
+        'duracion': 0.0
+    }
+
+def obtener_serie_producto(short_name, gdf_proj, bbox, fecha_inicio, fecha_fin, extraer, texto, firma):
+    """
+    Actualiza el cubo local del producto con los gránulos que faltan para el
+    rango pedido y devuelve la serie del rango desde el cubo. El cubo registra
+    los GranuleUR guardados y las fechas con gránulos fallidos, que se vuelven
+    a pedir en la siguiente ejecución en vez de quedar como huecos.
+    """
+    res = TAMANO_TESELA_MODIS / PIXELES_PRODUCTO[short_name]
+    ventana, transform = ventana_global_modis(gdf_proj, res)
+    ruta = ruta_cubo(short_name, ventana)
+    cubo = cargar_cubo(ruta, firma)
+    guardados = set(_lista_attr(cubo, 'granulos') or [])
+    # Cubos anteriores al registro de gránulos: sus fechas se dan por completas
+    fechas_cubo = set(pd.DatetimeIndex(cubo['time'].values)) if cubo is not None and 'granulos' not in cubo.attrs else set()
+
+    granulos = []
+    intervalos = intervalos_pendientes(cubo, fecha_inicio, fecha_fin)
+    for desde, hasta in intervalos:
+        encontrados = earthaccess.search_data(
+            short_name=short_name,
+            version='061',
+            bounding_box=bbox,
+            temporal=(desde.strftime('%Y-%m-%d'), hasta.strftime('%Y-%m-%d'))
+        )
+        granulos += [g for g in filtrar_granulos_por_teselas(encontrados or [], gdf_proj)
+                     if g['umm']['GranuleUR'] not in guardados and pd.Timestamp(fecha_granulo(g)) not in fechas_cubo]
+    granulos = list({g['umm']['GranuleUR']: g for g in granulos}.values())
+
+    # Las fechas incompletas que se han vuelto a buscar dejan de estarlo salvo que fallen otra vez
+    incompletas = {f for f in _lista_attr(cubo, 'fechas_incompletas') or []
+                   if not any(d <= pd.Timestamp(f) <= h for d, h in intervalos)}
+    if granulos:
+        n_teselas = len({tesela_granulo(g) for g in granulos})
+        st.info(f"Procesando {len(granulos)} escena(s) {short_name} nuevas en {n_teselas} tesela(s)")
+        serie = procesar_serie_granulos(granulos, gdf_proj, extraer, texto)
+        informar_rendimiento_serie(serie, short_name)
+        if serie['fechas']:
+            cubo = anexar_al_cubo(cubo, serie, transform, firma)
+        procesados = set(serie['granulos_procesados'])
+        guardados |= procesados
+        fallidas = {pd.Timestamp(fecha_granulo(g)).isoformat() for g in granulos
+                    if g['umm']['GranuleUR'] not in procesados}
+        incompletas |= fallidas
+        if fallidas:
+            st.warning(f"⚠️ {len(fallidas)} fecha(s) {short_name} incompletas; se reintentarán en la próxima ejecución.")
+    if cubo is None:
+        return None
+
+    cubo.attrs['granulos'] = json.dumps(sorted(guardados))
+    cubo.attrs['fechas_incompletas'] = json.dumps(sorted(incompletas))
+
+    # Lo buscado queda consultado hasta la última fecha guardada: los gránulos
+    # posteriores pueden no estar publicados aún y se vuelven a buscar
+    ultima = _dia(cubo['time'].values.max()) if cubo.sizes['time'] else None
+    consultados = intervalos_consultados(cubo) + [(d, min(h, ultima)) for d, h in intervalos
+                                                  if ultima is not None and d <= ultima]
+    cubo.attrs['intervalos_consultados'] = json.dumps(
+        [(d.date().isoformat(), h.date().isoformat()) for d, h in fusionar_intervalos(consultados)])
+    cubo.attrs.pop('consultado_desde', None)
+    guardar_cubo(cubo, ruta)
+
+    t0 = time.time()
+    serie = serie_desde_cubo(cubo, fecha_inicio, fecha_fin, transform, DIAS_COMPUESTO[short_name])
+    if serie is not None:
+        st.caption(f"📦 Cubo local {short_name}: {len(serie['fechas'])} fecha(s) en el rango "
+                   f"de {cubo.sizes['time']} guardadas ({(time.time() - t0) * 1000:.0f} ms)")
+    return serie
+
 # ===== FUNCIONES PARA DATOS SATELITALES (CORREGIDAS) =====
-def obtener_ndvi_earthdata(gdf_dividido, fecha_inicio, fecha_fin):
+def obtener_ndvi_earthdata(gdf_dividido, fecha_inicio, fecha_fin, extras=None):
     if not EARTHDATA_OK:
         st.error("Librerías earthaccess/xarray/rioxarray no instaladas.")
         return None
     if not EARTHDATA_USERNAME or not EARTHDATA_PASSWORD:
         st.error("Credenciales de Earthdata no configuradas.")
         return None
+    if not PYHDF_OK:
+        st.error("No se pudo leer el archivo HDF: pyhdf no está disponible.")
+        return None
     try:
         auth = earthaccess.login()
         if not auth.authenticated:
@@ -384,147 +1514,31 @@ def obtener_ndvi_earthdata(gdf_dividido, fecha_inicio, fecha_fin):
         bounds = gdf_dividido.total_bounds
         bbox = (bounds[0], bounds[1], bounds[2], bounds[3])
 
-        results = earthaccess.search_data(
-            short_name='MOD13Q1',
-            version='061',
-            bounding_box=bbox,
-            temporal=(fecha_inicio.strftime('%Y-%m-%d'), fecha_fin.strftime('%Y-%m-%d')),
-            count=5
-        )
-
-        if not results:
+        gdf_proj = gdf_dividido.to_crs(PROJ4_SINUSOIDAL_MODIS)
+        serie = obtener_serie_producto('MOD13Q1', gdf_proj, bbox, fecha_inicio, fecha_fin,
+                                       _extraer_ndvi_mod13q1, "Procesando gránulos NDVI...",
+                                       firma='ndvi_modis')
+        if serie is None:
             st.error("No se encontraron escenas MOD13Q1 en el período.")
             return None
 
-        granule = results[0]
-        st.info(f"Procesando escena NDVI: {granule['umm']['GranuleUR']}")
-
-        temp_dir = tempfile.mkdtemp()
-        downloaded_files = earthaccess.download(granule, local_path=temp_dir)
-        if not downloaded_files:
-            st.error("No se pudo descargar el archivo.")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
-
-        hdf_files = [f for f in downloaded_files if f.endswith('.hdf')]
-        if not hdf_files:
-            st.error("No se encontró archivo HDF en la descarga.")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
-        download_path = hdf_files[0]
-
-        file_size = os.path.getsize(download_path)
-        if file_size < 10240:
-            with open(download_path, 'r', errors='ignore') as f:
-                head = f.read(500).lower()
-                if '<html' in head:
-                    st.error("El archivo descargado parece ser una página HTML de error.")
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    return None
-
-        # Intento con pyhdf (MODIS usa HDF4, rasterio no lo soporta nativamente)
-        if PYHDF_OK:
-            try:
-                hdf = SD(download_path, SDC.READ)
-                ndvi_dataset = None
-                for name in hdf.datasets().keys():
-                    if 'NDVI' in name:
-                        ndvi_dataset = name
-                        break
-                if ndvi_dataset is None:
-                    st.error("No se encontró dataset NDVI en el archivo HDF.")
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    return None
-                ndvi_data = hdf.select(ndvi_dataset).get()
-                ndvi_scaled = ndvi_data.astype(np.float32) * 0.0001
-                
-                metadata = hdf.attributes().get('StructMetadata.0', '')
-                xdim_match = re.search(r'XDim\s*=\s*(\d+)', metadata, re.IGNORECASE)
-                ydim_match = re.search(r'YDim\s*=\s*(\d+)', metadata, re.IGNORECASE)
-                ul_match = re.search(r'UpperLeftPointMtrs\s*=\s*\(\s*([+-]?\d+\.?\d*)\s*,\s*([+-]?\d+\.?\d*)\s*\)', metadata, re.IGNORECASE)
-                lr_match = re.search(r'LowerRightMtrs\s*=\s*\(\s*([+-]?\d+\.?\d*)\s*,\s*([+-]?\d+\.?\d*)\s*\)', metadata, re.IGNORECASE)
-                
-                if not (xdim_match and ydim_match and ul_match and lr_match):
-                    ydim, xdim = ndvi_scaled.shape
-                    ulx, uly = -180, 90
-                    lrx, lry = 180, -90
-                    st.warning("No se pudo extraer geolocalización completa. Usando estimación.")
-                else:
-                    xdim = int(xdim_match.group(1))
-                    ydim = int(ydim_match.group(1))
-                    ulx = float(ul_match.group(1))
-                    uly = float(ul_match.group(2))
-                    lrx = float(lr_match.group(1))
-                    lry = float(lr_match.group(2))
-                
-                if ndvi_scaled.shape != (ydim, xdim):
-                    ydim, xdim = ndvi_scaled.shape
-                    
-                res_x = (lrx - ulx) / xdim if xdim > 0 else 0.01
-                res_y = (uly - lry) / ydim if ydim > 0 else 0.01
-                
-                transform = rasterio.Affine(res_x, 0, ulx, 0, -res_y, uly)
-                crs = rasterio.crs.CRS.from_proj4("+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 +b=6371007.181 +units=m +no_defs")
-                
-                with rasterio.io.MemoryFile() as memfile:
-                    with memfile.open(
-                        driver='GTiff',
-                        height=ydim,
-                        width=xdim,
-                        count=1,
-                        dtype=ndvi_scaled.dtype,
-                        crs=crs,
-                        transform=transform,
-                        nodata=-32768
-                    ) as dst:
-                        dst.write(ndvi_scaled, 1)
-                    with memfile.open() as src_ndvi:
-                        gdf_proj = gdf_dividido.to_crs(crs)
-                        ndvi_values = []
-                        progress_bar = st.progress(0, text="Procesando bloques para NDVI con pyhdf...")
-                        for idx, row in gdf_proj.iterrows():
-                            geom = [mapping(row.geometry)]
-                            try:
-                                # CORRECCIÓN: Manejar unpack de mask()
-                                mask_result = mask(src_ndvi, geom, crop=True, nodata=-32768)
-                                if len(mask_result) >= 2:
-                                    out_image, _ = mask_result
-                                else:
-                                    out_image = mask_result[0]
-                                data = out_image[0]
-                                mask_invalid = (data == -32768) | (data < -1) | (data > 1)
-                                data_clean = np.ma.masked_where(mask_invalid, data)
-                                mean_val = data_clean.mean()
-                                if np.ma.is_masked(mean_val) or np.isnan(mean_val):
-                                    ndvi_values.append(np.nan)
-                                else:
-                                    ndvi_values.append(round(float(mean_val), 3))
-                            except Exception:
-                                ndvi_values.append(np.nan)
-                            progress_bar.progress((idx + 1) / len(gdf_proj),
-                                                  text=f"Procesando bloque {idx+1}/{len(gdf_proj)}")
-                        progress_bar.empty()
-                        gdf_dividido['ndvi_modis'] = ndvi_values
-                        st.success("✅ NDVI calculado por bloque correctamente con pyhdf.")
-                        shutil.rmtree(temp_dir, ignore_errors=True)
-                        return gdf_dividido
-            except Exception as e_pyhdf:
-                st.error(f"Error al procesar con pyhdf: {str(e_pyhdf)}")
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                return None
-        else:
-            st.error("No se pudo leer el archivo HDF: pyhdf no está disponible.")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
+        aplicar_serie_a_bloques(gdf_dividido, gdf_proj, serie, extras)
+        if extras is not None:
+            extras.setdefault('series_pixeles', {})['MOD13Q1'] = serie
+        st.success(f"✅ NDVI calculado por bloque ({len(serie['fechas'])} fechas, mediana temporal).")
+        return gdf_dividido
     except Exception as e:
         st.error(f"Error en obtención de NDVI: {str(e)}")
         return None
 
 
-def obtener_ndwi_earthdata(gdf_dividido, fecha_inicio, fecha_fin):
+def obtener_indices_mod09_earthdata(gdf_dividido, fecha_inicio, fecha_fin, extras=None, indices=None):
     """
-    CORREGIDO: Manejo robusto del error 'not enough values to unpack'
-    MODIS usa HDF4, rasterio no lo soporta nativamente, usamos pyhdf
+    Índices espectrales declarados en INDICES_ESPECTRALES (NDWI, EVI, SAVI,
+    GNDVI, NBR, NDVI) a partir de la reflectancia MOD09A1 de todas las escenas
+    del período; cada índice se añade como columna de gdf_dividido. MODIS usa
+    HDF4, rasterio no lo soporta nativamente, usamos pyhdf.
+    Si se pasa `extras` (dict), allí quedan las series bloque x fecha y las estadísticas zonales.
     """
     if not EARTHDATA_OK:
         st.error("Librerías earthaccess/xarray/rioxarray no instaladas.")
@@ -532,6 +1546,9 @@ def obtener_ndwi_earthdata(gdf_dividido, fecha_inicio, fecha_fin):
     if not EARTHDATA_USERNAME or not EARTHDATA_PASSWORD:
         st.error("Credenciales de Earthdata no configuradas.")
         return None
+    if not PYHDF_OK:
+        st.error("pyhdf no está instalado. Instale con: pip install pyhdf")
+        return None
     try:
         auth = earthaccess.login()
         if not auth.authenticated:
@@ -541,221 +1558,193 @@ def obtener_ndwi_earthdata(gdf_dividido, fecha_inicio, fecha_fin):
         bounds = gdf_dividido.total_bounds
         bbox = (bounds[0], bounds[1], bounds[2], bounds[3])
 
-        # MOD09GA tiene resolución de 500m
-        results = earthaccess.search_data(
-            short_name='MOD09GA',
-            version='061',
-            bounding_box=bbox,
-            temporal=(fecha_inicio.strftime('%Y-%m-%d'), fecha_fin.strftime('%Y-%m-%d')),
-            count=5
-        )
+        # Compuesto de 8 días MOD09A1 a 500 m: el diario MOD09GA supondría un gránulo por
+        # tesela y día (varios GB en 60 días) que desbordaría la caché de gránulos.
+        # El cubo guarda siempre todos los índices declarados.
+        gdf_proj = gdf_dividido.to_crs(PROJ4_SINUSOIDAL_MODIS)
+        firma = ','.join(sorted(INDICES_ESPECTRALES))
+        serie = obtener_serie_producto('MOD09A1', gdf_proj, bbox, fecha_inicio, fecha_fin,
+                                       _extraer_indices_mod09, "Procesando gránulos MOD09A1...", firma)
+        if serie is None:
+            # Fallback a MOD09Q1 si MOD09A1 no está disponible
+            st.info("MOD09A1 no disponible, intentando con MOD09Q1...")
+            serie = obtener_serie_producto('MOD09Q1', gdf_proj, bbox, fecha_inicio, fecha_fin,
+                                           _extraer_indices_mod09, "Procesando gránulos MOD09Q1...", firma)
+        
+        if serie is None:
+            st.error("No se encontraron escenas MOD09A1/MOD09Q1 en el período.")
+            return None
+        if indices is not None:
+            serie['pilas'] = {c: p for c, p in serie['pilas'].items() if c in indices}
+
+        aplicar_serie_a_bloques(gdf_dividido, gdf_proj, serie, extras)
+        if extras is not None:
+            extras.setdefault('series_pixeles', {})['MOD09'] = serie
+        nombres = ', '.join(INDICES_ESPECTRALES[c]['nombre'] for c in serie['pilas'])
+        st.success(f"✅ {nombres} calculados por bloque ({len(serie['fechas'])} fechas, mediana temporal).")
+        return gdf_dividido
+    except Exception as e:
+        st.error(f"Error en obtención de índices MOD09: {str(e)}")
+        import traceback
+        st.code(traceback.format_exc())
+        return None
+
+# ===== CLIENTE HTTP COMPARTIDO =====
+# Open-Meteo y NASA POWER: una sesión con pool de conexiones y reintentos con
+# backoff, y una caché SQLite de respuestas con TTL para no repetir llamadas.
+CACHE_HTTP_RUTA = os.environ.get(
+    "HTTP_CACHE_PATH", os.path.join(tempfile.gettempdir(), "palma_http_cache.sqlite")
+)
+CACHE_HTTP_TTL_S = float(os.environ.get("HTTP_CACHE_TTL_HORAS", "24")) * 3600
+DECIMALES_COORDENADAS = 2  # ~1 km, muy por debajo de la celda ERA5 (0.25°) o POWER (0.5°)
 
-        if not results:
-            # Fallback a MOD09Q1 si MOD09GA no está disponible
-            st.info("MOD09GA no disponible, intentando con MOD09Q1...")
-            results = earthaccess.search_data(
-                short_name='MOD09Q1',
-                version='061',
-                bounding_box=bbox,
-                temporal=(fecha_inicio.strftime('%Y-%m-%d'), fecha_fin.strftime('%Y-%m-%d')),
-                count=5
+@st.cache_resource
+def _estado_http():
+    """Sesión y caché compartidas. Son GET sin cookies ni autenticación, así que una sesión sirve a todos los hilos."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    reintentos = Retry(
+        total=4, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']), respect_retry_after_header=True
+    )
+    sesion = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=reintentos)
+    sesion.mount('https://', adaptador)
+    sesion.mount('http://', adaptador)
+    with conexion_sqlite(CACHE_HTTP_RUTA) as con:
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS respuestas (
+                clave TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                cuerpo TEXT NOT NULL,
+                creado REAL NOT NULL
             )
-        
-        if not results:
-            st.error("No se encontraron escenas MOD09GA/MOD09Q1 en el período.")
-            return None
+        """)
+    return {'sesion': sesion, 'lock': threading.Lock(), 'aciertos': 0, 'llamadas': 0}
 
-        granule = results[0]
-        st.info(f"Procesando escena NDWI: {granule['umm']['GranuleUR']}")
+def _normalizar_parametros(params):
+    """Redondea lat/lon para que parcelas vecinas compartan la misma entrada de caché."""
+    normalizados = {}
+    for k, v in params.items():
+        if k in ('latitude', 'longitude') and not isinstance(v, str):
+            v = round(float(v), DECIMALES_COORDENADAS)
+        normalizados[k] = v
+    return normalizados
 
-        temp_dir = tempfile.mkdtemp()
-        downloaded_files = earthaccess.download(granule, local_path=temp_dir)
-        if not downloaded_files:
-            st.error("No se pudo descargar el archivo.")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
+def http_get_json(url, params, ttl=CACHE_HTTP_TTL_S, timeout=(10, 60), definitivo_desde=None):
+    """
+    GET JSON con caché SQLite (clave: url + parámetros normalizados) y
+    reintentos. Una respuesta guardada después de `definitivo_desde` (epoch)
+    ya no caduca; las demás duran `ttl` segundos. Lanza la excepción de
+    requests solo cuando se agotan los reintentos.
+    """
+    estado = _estado_http()
+    params = _normalizar_parametros(params)
+    clave = hashlib.sha256((url + json.dumps(params, sort_keys=True, default=str)).encode()).hexdigest()
+    # Los contadores se leen desde otros hilos: se actualizan con el mismo lock que la caché
+    with estado['lock'], conexion_sqlite(CACHE_HTTP_RUTA) as con:
+        fila = con.execute("SELECT cuerpo, creado FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+        vigente = fila is not None and (time.time() - fila[1] < ttl or
+                                        (definitivo_desde is not None and fila[1] >= definitivo_desde))
+        if vigente:
+            estado['aciertos'] += 1
+    if vigente:
+        return json.loads(fila[0])
 
-        hdf_files = [f for f in downloaded_files if f.endswith('.hdf')]
-        if not hdf_files:
-            st.error("No se encontró archivo HDF en la descarga.")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
-        download_path = hdf_files[0]
-
-        file_size = os.path.getsize(download_path)
-        if file_size < 10240:
-            with open(download_path, 'r', errors='ignore') as f:
-                head = f.read(500).lower()
-                if '<html' in head:
-                    st.error("El archivo descargado parece ser una página HTML de error.")
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    return None
+    respuesta = estado['sesion'].get(url, params=params, timeout=timeout)
+    respuesta.raise_for_status()
+    datos = respuesta.json()
+    with estado['lock'], conexion_sqlite(CACHE_HTTP_RUTA) as con:
+        estado['llamadas'] += 1
+        con.execute("INSERT OR REPLACE INTO respuestas VALUES (?, ?, ?, ?)",
+                    (clave, url, respuesta.text, time.time()))
+    return datos
 
-        # NOTA: MODIS usa HDF4, rasterio.open() no lo soporta directamente
-        # Usamos pyhdf para leer los datos y luego creamos GeoTIFF en memoria
-        
-        if not PYHDF_OK:
-            st.error("pyhdf no está instalado. Instale con: pip install pyhdf")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
+MAX_HILOS_HTTP = 4
+DIAS_DATOS_DEFINITIVOS = 30  # los meses cerrados hace más de esto ya no cambian en el reanálisis
 
-        try:
-            hdf = SD(download_path, SDC.READ)
-            nir_data = None
-            swir_data = None
-            
-            # Buscar bandas NIR (B02) y SWIR (B06) para NDWI
-            for name in hdf.datasets().keys():
-                name_upper = name.upper()
-                if 'SUR_REFL_B02' in name_upper or 'B02_1KM' in name_upper or 'B02' in name_upper:
-                    try:
-                        nir_data = hdf.select(name).get()
-                        st.info(f"✅ Banda NIR encontrada: {name}")
-                    except Exception as e:
-                        st.warning(f"No se pudo leer {name}: {e}")
-                elif 'SUR_REFL_B06' in name_upper or 'B06_1KM' in name_upper or 'B06' in name_upper:
-                    try:
-                        swir_data = hdf.select(name).get()
-                        st.info(f"✅ Banda SWIR encontrada: {name}")
-                    except Exception as e:
-                        st.warning(f"No se pudo leer {name}: {e}")
-            
-            # Fallback: buscar por patrones alternativos
-            if nir_data is None:
-                for name in hdf.datasets().keys():
-                    if 'REFL' in name.upper() and '02' in name:
-                        try:
-                            nir_data = hdf.select(name).get()
-                            st.info(f"✅ Banda NIR (fallback): {name}")
-                            break
-                        except:
-                            continue
-            
-            if swir_data is None:
-                for name in hdf.datasets().keys():
-                    if 'REFL' in name.upper() and '06' in name:
-                        try:
-                            swir_data = hdf.select(name).get()
-                            st.info(f"✅ Banda SWIR (fallback): {name}")
-                            break
-                        except:
-                            continue
-            
-            if nir_data is None or swir_data is None:
-                st.error(f"No se encontraron las bandas NIR o SWIR. Datasets disponibles: {list(hdf.datasets().keys())[:10]}")
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                return None
-            
-            # Escalar datos (factor de escala MODIS = 0.0001)
-            nir = nir_data.astype(np.float32) * 0.0001
-            swir = swir_data.astype(np.float32) * 0.0001
+def tramos_mensuales(fecha_inicio, fecha_fin):
+    """Meses naturales completos que cubren el rango; el mes en curso se recorta a hoy."""
+    hoy = pd.Timestamp.now().normalize()
+    meses = pd.period_range(pd.Timestamp(fecha_inicio), pd.Timestamp(fecha_fin), freq='M')
+    tramos = [(m.start_time, min(m.end_time.normalize(), hoy)) for m in meses]
+    return [(inicio, fin) for inicio, fin in tramos if fin >= inicio]
 
-            # Extraer metadata de geolocalización
-            metadata = hdf.attributes().get('StructMetadata.0', '')
-            
-            xdim_match = re.search(r'XDim\s*=\s*(\d+)', metadata, re.IGNORECASE)
-            ydim_match = re.search(r'YDim\s*=\s*(\d+)', metadata, re.IGNORECASE)
-            ul_match = re.search(r'UpperLeftPointMtrs\s*=\s*\(\s*([+-]?\d+\.?\d*)\s*,\s*([+-]?\d+\.?\d*)\s*\)', metadata, re.IGNORECASE)
-            lr_match = re.search(r'LowerRightMtrs\s*=\s*\(\s*([+-]?\d+\.?\d*)\s*,\s*([+-]?\d+\.?\d*)\s*\)', metadata, re.IGNORECASE)
-            
-            if not (xdim_match and ydim_match and ul_match and lr_match):
-                # Fallback: usar dimensiones del array directamente
-                ydim, xdim = nir.shape
-                ulx, uly = -180, 90
-                lrx, lry = 180, -90
-                st.warning("No se pudo extraer geolocalización completa del metadata. Usando estimación.")
-            else:
-                xdim = int(xdim_match.group(1))
-                ydim = int(ydim_match.group(1))
-                ulx = float(ul_match.group(1))
-                uly = float(ul_match.group(2))
-                lrx = float(lr_match.group(1))
-                lry = float(lr_match.group(2))
-            
-            # Asegurar consistencia de dimensiones
-            if nir.shape != (ydim, xdim):
-                ydim, xdim = nir.shape
-                st.info(f"Ajustando dimensiones a: {ydim}x{xdim}")
-                    
-            res_x = (lrx - ulx) / xdim if xdim > 0 else 0.01
-            res_y = (uly - lry) / ydim if ydim > 0 else 0.01
-            
-            transform = rasterio.Affine(res_x, 0, ulx, 0, -res_y, uly)
-            crs = rasterio.crs.CRS.from_proj4("+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 +b=6371007.181 +units=m +no_defs")
-            
-            st.info(f"Creando GeoTIFF en memoria: {ydim}x{xdim}, CRS: SINUSOIDAL")
-            
-            # Crear GeoTIFF en memoria para NIR y SWIR
-            with rasterio.io.MemoryFile() as memfile_nir, rasterio.io.MemoryFile() as memfile_swir:
-                with memfile_nir.open(driver='GTiff', height=ydim, width=xdim, count=1,
-                                      dtype=nir.dtype, crs=crs, transform=transform, nodata=-32768) as dst_nir:
-                    dst_nir.write(nir, 1)
-                with memfile_swir.open(driver='GTiff', height=ydim, width=xdim, count=1,
-                                      dtype=swir.dtype, crs=crs, transform=transform, nodata=-32768) as dst_swir:
-                    dst_swir.write(swir, 1)
-                
-                # Abrir para lectura
-                with memfile_nir.open() as src_nir, memfile_swir.open() as src_swir:
-                    gdf_proj = gdf_dividido.to_crs(crs)
-                    ndwi_values = []
-                    progress_bar = st.progress(0, text="Procesando bloques para NDWI con pyhdf...")
-                    
-                    for idx, row in gdf_proj.iterrows():
-                        geom = [mapping(row.geometry)]
-                        try:
-                            # CORRECCIÓN PRINCIPAL: Manejar unpack de mask() correctamente
-                            mask_nir = mask(src_nir, geom, crop=True, nodata=-32768)
-                            mask_swir = mask(src_swir, geom, crop=True, nodata=-32768)
-                            
-                            # Verificar longitud antes de unpack
-                            if len(mask_nir) >= 2:
-                                out_nir, _ = mask_nir
-                            else:
-                                out_nir = mask_nir[0]
-                            
-                            if len(mask_swir) >= 2:
-                                out_swir, _ = mask_swir
-                            else:
-                                out_swir = mask_swir[0]
-                            
-                            nir_band = out_nir[0].astype(np.float32)
-                            swir_band = out_swir[0].astype(np.float32)
-                            
-                            # Calcular NDWI: (NIR - SWIR) / (NIR + SWIR)
-                            valid = (nir_band != -32768) & (swir_band != -32768) & (nir_band + swir_band != 0)
-                            nir_valid = np.ma.masked_where(~valid, nir_band)
-                            swir_valid = np.ma.masked_where(~valid, swir_band)
-                            
-                            with np.errstate(divide='ignore', invalid='ignore'):
-                                ndwi = (nir_valid - swir_valid) / (nir_valid + swir_valid)
-                            mean_val = ndwi.mean()
-                            
-                            if np.ma.is_masked(mean_val) or np.isnan(mean_val):
-                                ndwi_values.append(np.nan)
-                            else:
-                                ndwi_values.append(round(float(mean_val), 3))
-                        except Exception as e_block:
-                            st.warning(f"Bloque {idx} falló: {str(e_block)[:50]}")
-                            ndwi_values.append(np.nan)
-                        
-                        progress_bar.progress((idx + 1) / len(gdf_proj),
-                                              text=f"Procesando bloque {idx+1}/{len(gdf_proj)}")
-                    progress_bar.empty()
-                    gdf_dividido['ndwi_modis'] = ndwi_values
-                    st.success("✅ NDWI calculado por bloque correctamente con pyhdf.")
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    return gdf_dividido
-        except Exception as e_pyhdf:
-            st.error(f"Error al procesar con pyhdf: {str(e_pyhdf)}")
-            import traceback
-            st.code(traceback.format_exc())
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return None
-    except Exception as e:
-        st.error(f"Error en obtención de NDWI: {str(e)}")
-        return None
+def http_get_json_por_meses(url, params, fecha_inicio, fecha_fin, claves_fecha, formato):
+    """
+    Pide el rango mes a mes, en paralelo y con caché por mes, de modo que
+    ampliar una serie larga solo descarga los meses nuevos. Un mes guardado
+    cuando ya era definitivo no caduca; uno guardado antes (reanálisis con
+    retraso, valores de relleno) sigue el TTL normal aunque ya haya envejecido.
+    Devuelve las respuestas en orden cronológico.
+    """
+    def pedir(tramo):
+        inicio, fin = tramo
+        p = {**params, claves_fecha[0]: inicio.strftime(formato), claves_fecha[1]: fin.strftime(formato)}
+        definitivo_desde = (fin + pd.Timedelta(days=DIAS_DATOS_DEFINITIVOS)).timestamp()
+        return http_get_json(url, p, definitivo_desde=definitivo_desde)
+
+    _estado_http()  # inicializa sesión y caché en el hilo principal
+    with _pool_con_contexto(MAX_HILOS_HTTP) as pool:
+        return list(pool.map(pedir, tramos_mensuales(fecha_inicio, fecha_fin)))
+
+def estadisticas_cache_http():
+    estado = _estado_http()
+    with estado['lock'], conexion_sqlite(CACHE_HTTP_RUTA) as con:
+        n_respuestas = con.execute("SELECT COUNT(*) FROM respuestas").fetchone()[0]
+        return {'aciertos': estado['aciertos'], 'llamadas': estado['llamadas'], 'respuestas': n_respuestas}
 
 # ===== FUNCIONES CLIMÁTICAS =====
+def serie_climatica(fechas, **columnas):
+    """Serie diaria indexada por fecha: una columna float32 por variable (precipitacion, temp_media, ...)."""
+    indice = pd.DatetimeIndex(fechas, name='fecha').normalize()
+    return pd.DataFrame({k: np.asarray(v, dtype=np.float32) for k, v in columnas.items()}, index=indice)
+
+def _redondear(valor):
+    return round(float(valor), 1)
+
+def resumir_clima(serie):
+    """Resúmenes (promedio, máximos, días con lluvia...) de las columnas presentes, sin bucles por día."""
+    serie = serie.astype(np.float64)  # se guarda en float32; se agrega en float64
+    resumen = {}
+    if 'precipitacion' in serie:
+        p = serie['precipitacion']
+        resumen['precipitacion'] = {
+            'total': _redondear(p.sum()),
+            'maxima_diaria': _redondear(p.max()) if p.notna().any() else 0.0,
+            'dias_con_lluvia': int((p > 0.1).sum())
+        }
+    if 'temp_media' in serie:
+        t = serie['temp_media']
+        resumen['temperatura'] = {
+            'promedio': _redondear(t.mean()),
+            'maxima': _redondear(serie.get('temp_max', t).max()),
+            'minima': _redondear(serie.get('temp_min', t).min())
+        }
+    if 'radiacion' in serie:
+        r = serie['radiacion']
+        resumen['radiacion'] = {'promedio': _redondear(r.mean()), 'maxima': _redondear(r.max()),
+                                'minima': _redondear(r.min())}
+    if 'viento' in serie:
+        v = serie['viento']
+        resumen['viento'] = {'promedio': _redondear(v.mean()), 'maxima': _redondear(v.max())}
+    return resumen
+
+def datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, fuente):
+    return {
+        'serie': serie,
+        **resumir_clima(serie),
+        'periodo': f"{fecha_inicio.strftime('%d/%m/%Y')} - {fecha_fin.strftime('%d/%m/%Y')}",
+        'fuente': fuente
+    }
+
+def combinar_datos_climaticos(principal, secundario):
+    """Une por fecha la serie principal (lluvia/temperatura) con la de radiación/viento y recalcula los resúmenes."""
+    extra = secundario['serie'][[c for c in secundario['serie'].columns if c not in principal['serie'].columns]]
+    serie = principal['serie'].join(extra, how='outer')
+    return {**principal, **resumir_clima(serie), 'serie': serie,
+            'fuente_radiacion': secundario.get('fuente', 'N/A')}
+
 def obtener_clima_openmeteo(gdf, fecha_inicio, fecha_fin):
     try:
         centroide = gdf.geometry.unary_union.centroid
@@ -765,37 +1754,25 @@ def obtener_clima_openmeteo(gdf, fecha_inicio, fecha_fin):
         params = {
             "latitude": lat,
             "longitude": lon,
-            "start_date": fecha_inicio.strftime("%Y-%m-%d"),
-            "end_date": fecha_fin.strftime("%Y-%m-%d"),
             "daily": ["temperature_2m_max", "temperature_2m_min",
                      "temperature_2m_mean", "precipitation_sum"],
             "timezone": "auto"
         }
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        if "daily" not in data:
+        respuestas = http_get_json_por_meses(url, params, fecha_inicio, fecha_fin,
+                                             ("start_date", "end_date"), "%Y-%m-%d")
+        if not respuestas or any("daily" not in r for r in respuestas):
             raise ValueError("No se recibieron datos diarios")
-        tmax = [t if t is not None else np.nan for t in data["daily"]["temperature_2m_max"]]
-        tmin = [t if t is not None else np.nan for t in data["daily"]["temperature_2m_min"]]
-        tmean = [t if t is not None else np.nan for t in data["daily"]["temperature_2m_mean"]]
-        precip = [p if p is not None else 0.0 for p in data["daily"]["precipitation_sum"]]
-        return {
-            'precipitacion': {
-                'total': round(sum(precip), 1),
-                'maxima_diaria': round(max(precip) if precip else 0, 1),
-                'dias_con_lluvia': sum(1 for p in precip if p > 0.1),
-                'diaria': [round(p, 1) for p in precip]
-            },
-            'temperatura': {
-                'promedio': round(np.nanmean(tmean), 1),
-                'maxima': round(np.nanmax(tmax), 1),
-                'minima': round(np.nanmin(tmin), 1),
-                'diaria': [round(t, 1) if not np.isnan(t) else np.nan for t in tmean]
-            },
-            'periodo': f"{fecha_inicio.strftime('%d/%m/%Y')} - {fecha_fin.strftime('%d/%m/%Y')}",
-            'fuente': 'Open-Meteo ERA5'
-        }
+        diario = pd.concat([pd.DataFrame(r["daily"]) for r in respuestas], ignore_index=True)
+        fechas = pd.to_datetime(diario["time"])
+        diario = diario[(fechas >= pd.Timestamp(fecha_inicio).normalize()) & (fechas <= pd.Timestamp(fecha_fin))]
+        serie = serie_climatica(
+            pd.to_datetime(diario["time"]),
+            precipitacion=diario["precipitation_sum"].astype(float).fillna(0.0),
+            temp_media=diario["temperature_2m_mean"].astype(float),
+            temp_max=diario["temperature_2m_max"].astype(float),
+            temp_min=diario["temperature_2m_min"].astype(float)
+        )
+        return datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, 'Open-Meteo ERA5')
     except Exception as e:
         st.warning(f"⚠️ Error en Open-Meteo: {str(e)[:100]}. Usando datos simulados.")
         return generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin)
@@ -810,105 +1787,156 @@ def obtener_radiacion_viento_power(gdf, fecha_inicio, fecha_fin):
         url = "https://power.larc.nasa.gov/api/temporal/daily/point"
         params = {
             "parameters": "ALLSKY_SFC_SW_DWN,WS2M",
-            "community": "RE",
+            "community": "AG",
             "longitude": lon,
             "latitude": lat,
-            "start": start,
-            "end": end,
             "format": "JSON"
         }
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        props = data['properties']['parameter']
-        radiacion = props.get('ALLSKY_SFC_SW_DWN', {})
-        viento = props.get('WS2M', {})
-        fechas = sorted(radiacion.keys())
-        rad_diaria = [radiacion[f] for f in fechas]
-        wind_diaria = [viento[f] for f in fechas]
-        rad_diaria = [np.nan if r == -999 else r for r in rad_diaria]
-        wind_diaria = [np.nan if w == -999 else w for w in wind_diaria]
-        return {
-            'radiacion': {
-                'promedio': round(np.nanmean(rad_diaria), 1),
-                'maxima': round(np.nanmax(rad_diaria), 1),
-                'minima': round(np.nanmin(rad_diaria), 1),
-                'diaria': [round(r, 1) if not np.isnan(r) else np.nan for r in rad_diaria]
-            },
-            'viento': { 
-                'promedio': round(np.nanmean(wind_diaria), 1),
-                'maxima': round(np.nanmax(wind_diaria), 1),
-                'diaria': [round(w, 1) if not np.isnan(w) else np.nan for w in wind_diaria]
-            },
-            'fuente': 'NASA POWER'
-        }
+        respuestas = http_get_json_por_meses(url, params, fecha_inicio, fecha_fin, ("start", "end"), "%Y%m%d")
+        radiacion, viento = {}, {}
+        for data in respuestas:
+            props = data['properties']['parameter']
+            radiacion.update(props.get('ALLSKY_SFC_SW_DWN', {}))
+            viento.update(props.get('WS2M', {}))
+        # -999 es el valor de relleno de POWER
+        diario = pd.DataFrame({'radiacion': pd.Series(radiacion, dtype=float),
+                               'viento': pd.Series(viento, dtype=float)}).replace(-999.0, np.nan)
+        diario = diario[(diario.index >= start) & (diario.index <= end)].sort_index()
+        serie = serie_climatica(pd.to_datetime(diario.index, format='%Y%m%d'),
+                                radiacion=diario['radiacion'], viento=diario['viento'])
+        return datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, 'NASA POWER')
     except Exception as e:
         st.warning(f"⚠️ Error en NASA POWER: {str(e)[:100]}. Usando datos simulados.")
-        dias = (fecha_fin - fecha_inicio).days
-        if dias <= 0:
-            dias = 30
-        rad_diaria = [np.random.uniform(15, 25) for _ in range(dias)]
-        wind_diaria = [np.random.uniform(2, 6) for _ in range(dias)]
-        return {
-            'radiacion': {
-                'promedio': round(np.mean(rad_diaria), 1),
-                'maxima': round(max(rad_diaria), 1),
-                'minima': round(min(rad_diaria), 1),
-                'diaria': rad_diaria
-            },
-            'viento': {
-                'promedio': round(np.mean(wind_diaria), 1),
-                'maxima': round(max(wind_diaria), 1),
-                'diaria': wind_diaria
-            },
-            'fuente': 'Simulado (fallback)'
+        simulados = generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin)
+        serie = simulados['serie'][['radiacion', 'viento']]
+        return datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, 'Simulado (fallback)')
+
+RESOLUCION_CELDA_ERA5 = 0.25
+MAX_COORDENADAS_POR_LLAMADA = 100
+VARIABLES_CLIMA_BLOQUE = {
+    'temperature_2m_max': 'temp_max',
+    'temperature_2m_min': 'temp_min',
+    'temperature_2m_mean': 'temp_media',
+    'precipitation_sum': 'precipitacion',
+}
+
+def celdas_era5_bloques(gdf_dividido, resolucion=RESOLUCION_CELDA_ERA5):
+    """Celdas ERA5 únicas que contienen los centroides de los bloques y la celda de cada bloque."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        centroides = gdf_dividido.geometry.centroid
+    puntos = np.column_stack([
+        np.round(centroides.y.values / resolucion) * resolucion,
+        np.round(centroides.x.values / resolucion) * resolucion
+    ])
+    celdas, indice_celda = np.unique(puntos.round(4), axis=0, return_inverse=True)
+    return celdas, indice_celda.ravel()
+
+def obtener_clima_por_bloque(gdf_dividido, fecha_inicio, fecha_fin):
+    """
+    Clima diario de Open-Meteo ERA5 para cada bloque, pidiendo una sola vez
+    cada celda ERA5 y agrupando hasta MAX_COORDENADAS_POR_LLAMADA celdas por
+    llamada. Devuelve {variable: DataFrame bloque x día} más metadatos.
+    """
+    celdas, indice_celda = celdas_era5_bloques(gdf_dividido)
+    url = "https://archive-api.open-meteo.com/v1/archive"
+    por_celda = {}
+    n_llamadas = 0
+    for ini in range(0, len(celdas), MAX_COORDENADAS_POR_LLAMADA):
+        lote = celdas[ini:ini + MAX_COORDENADAS_POR_LLAMADA]
+        params = {
+            "latitude": ",".join(f"{lat:.2f}" for lat in lote[:, 0]),
+            "longitude": ",".join(f"{lon:.2f}" for lon in lote[:, 1]),
+            "daily": list(VARIABLES_CLIMA_BLOQUE),
+            "timezone": "auto"
         }
+        respuestas = http_get_json_por_meses(url, params, fecha_inicio, fecha_fin,
+                                             ("start_date", "end_date"), "%Y-%m-%d")
+        n_llamadas += len(respuestas)
+        for respuesta in respuestas:
+            # Con una sola coordenada Open-Meteo devuelve un objeto en lugar de una lista
+            ubicaciones = respuesta if isinstance(respuesta, list) else [respuesta]
+            if len(ubicaciones) != len(lote) or any('daily' not in u for u in ubicaciones):
+                raise ValueError("Respuesta de Open-Meteo incompleta para el lote de celdas")
+            for j, ubicacion in enumerate(ubicaciones):
+                por_celda.setdefault(ini + j, []).append(pd.DataFrame(ubicacion['daily']))
+
+    diarios = []
+    for k in range(len(celdas)):
+        diario = pd.concat(por_celda[k], ignore_index=True)
+        diarios.append(diario.set_index(pd.to_datetime(diario.pop('time'))))
+    fechas = diarios[0].index
+    fechas = fechas[(fechas >= pd.Timestamp(fecha_inicio).normalize()) & (fechas <= pd.Timestamp(fecha_fin))]
+
+    resultado = {'n_celdas': len(celdas), 'n_llamadas': n_llamadas,
+                 'celda': [f"{lat:.2f}, {lon:.2f}" for lat, lon in celdas[indice_celda]],
+                 'fuente': f'Open-Meteo ERA5 ({RESOLUCION_CELDA_ERA5}° por bloque)'}
+    for variable, nombre in VARIABLES_CLIMA_BLOQUE.items():
+        # (celdas x días) y luego cada bloque toma la fila de su celda
+        matriz = np.vstack([d[variable].reindex(fechas).astype(float).values for d in diarios])
+        resultado[nombre] = pd.DataFrame(matriz[indice_celda], index=gdf_dividido['id_bloque'].values, columns=fechas)
+    resultado['precipitacion'] = resultado['precipitacion'].fillna(0.0)
+    return resultado
+
+def semilla_simulacion(gdf, *claves):
+    """Semilla reproducible a partir de la geometría de la plantación y claves adicionales (p. ej. fechas)."""
+    huella = hashlib.sha1(gdf.geometry.unary_union.wkb)
+    for clave in claves:
+        huella.update(str(clave).encode())
+    return int.from_bytes(huella.digest()[:8], 'little')
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def serie_climatica_simulada(semilla, fecha_inicio, fecha_fin):
+    """
+    Clima diario sintético de llanos venezolanos con estacionalidad: lluvias de
+    mayo a noviembre, temperatura más alta al final de la estación seca y menos
+    radiación en días de lluvia. Todas las variables salen de un único
+    generador sembrado, por lo que el resultado es reproducible.
+    """
+    from scipy.signal import lfilter
+    fechas = pd.date_range(fecha_inicio, fecha_fin, freq='D')
+    dias = len(fechas)
+    rng = np.random.default_rng(semilla)
+    u, z = rng.random(dias), rng.standard_normal((3, dias))
+    fase = 2 * np.pi * (fechas.dayofyear.values - 1) / 365.25
+
+    # Estación lluviosa centrada en agosto
+    estacion = 0.5 * (1 + np.cos(fase - 2 * np.pi * 215 / 365.25))
+    llueve = u < 0.1 + 0.55 * estacion
+    precipitacion = np.where(llueve, rng.gamma(0.8, 4 + 10 * estacion), 0.0)
+
+    # Anomalías persistentes de varios días (AR(1) vía filtro lineal)
+    anomalia = lfilter([1.0], [1.0, -0.7], z, axis=1) * np.sqrt(1 - 0.7 ** 2)
+    temp_media = 26.5 + 1.2 * np.cos(fase - 2 * np.pi * 100 / 365.25) + 0.8 * anomalia[0] - 0.8 * llueve
+    amplitud = 11 - 4 * estacion + 0.8 * anomalia[1]
+    radiacion = np.clip(21 - 3 * estacion - 4 * llueve + 1.5 * anomalia[2], 8, 28)
+    viento = np.clip(2.0 + 1.5 * (1 - estacion) + 0.5 * anomalia[1], 0.5, None)
+    return serie_climatica(
+        fechas,
+        precipitacion=precipitacion,
+        temp_media=temp_media,
+        temp_max=temp_media + amplitud / 2,
+        temp_min=temp_media - amplitud / 2,
+        radiacion=radiacion,
+        viento=viento
+    )
 
 def generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin):
     try:
-        dias = (fecha_fin - fecha_inicio).days
-        if dias <= 0:
-            dias = 30
-        rad_diaria = [np.random.uniform(15, 25) for _ in range(dias)]
-        precip_diaria = [max(0, np.random.exponential(3) if np.random.random() > 0.7 else 0) for _ in range(dias)]
-        wind_diaria = [np.random.uniform(2, 6) for _ in range(dias)]
-        temp_diaria = [np.random.uniform(22, 28) for _ in range(dias)]
-        return {
-            'radiacion': {
-                'promedio': round(np.mean(rad_diaria), 1),
-                'maxima': round(max(rad_diaria), 1),
-                'minima': round(min(rad_diaria), 1),
-                'diaria': rad_diaria
-            },
-            'precipitacion': {
-                'total': round(sum(precip_diaria), 1),
-                'maxima_diaria': round(max(precip_diaria), 1),
-                'dias_con_lluvia': sum(1 for p in precip_diaria if p > 0.1),
-                'diaria': precip_diaria
-            },
-            'viento': {
-                'promedio': round(np.mean(wind_diaria), 1),
-                'maxima': round(max(wind_diaria), 1),
-                'diaria': wind_diaria
-            },
-            'temperatura': {
-                'promedio': round(np.mean(temp_diaria), 1),
-                'maxima': round(max(temp_diaria), 1),
-                'minima': round(min(temp_diaria), 1),
-                'diaria': temp_diaria
-            },
-            'periodo': f"{fecha_inicio.strftime('%d/%m/%Y')} - {fecha_fin.strftime('%d/%m/%Y')}",
-            'fuente': 'Simulado (fallback)'
-        }
+        inicio = pd.Timestamp(fecha_inicio).normalize()
+        fin = pd.Timestamp(fecha_fin).normalize()
+        if fin <= inicio:
+            fin = inicio + pd.Timedelta(days=29)
+        serie = serie_climatica_simulada(semilla_simulacion(gdf, inicio.date(), fin.date()), inicio, fin)
+        return datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, 'Simulado (fallback)')
     except:
-        return {
-            'radiacion': {'promedio': 18.0, 'maxima': 25.0, 'minima': 12.0, 'diaria': [18]*30},
-            'precipitacion': {'total': 90.0, 'maxima_diaria': 15.0, 'dias_con_lluvia': 10, 'diaria': [3]*30},
-            'viento': {'promedio': 3.0, 'maxima': 6.0, 'diaria': [3]*30},
-            'temperatura': {'promedio': 25.0, 'maxima': 30.0, 'minima': 20.0, 'diaria': [25]*30},
-            'periodo': 'Últimos 30 días',
-            'fuente': 'Simulado (fallback)'
-        }
+        fin = pd.Timestamp.now().normalize()
+        serie = serie_climatica(pd.date_range(end=fin, periods=30, freq='D'),
+                                precipitacion=np.full(30, 3.0), temp_media=np.full(30, 25.0),
+                                radiacion=np.full(30, 18.0), viento=np.full(30, 3.0))
+        datos = datos_climaticos_desde_serie(serie, fin - pd.Timedelta(days=29), fin, 'Simulado (fallback)')
+        datos['periodo'] = 'Últimos 30 días'
+        return datos
 
 def analizar_edad_plantacion(gdf_dividido):
     edades = []
@@ -923,6 +1951,328 @@ def analizar_edad_plantacion(gdf_dividido):
             edades.append(10.0)
     return edades
 
+# ===== CLIMA LOCAL DESDE NETCDF (ERA5 / CHIRPS) =====
+# Espejo local de NetCDF diarios para sitios con mala conectividad. Los archivos
+# se abren de forma perezosa y solo se lee el recorte bbox x tiempo necesario.
+CLIMA_LOCAL_DIR = os.environ.get("CLIMA_LOCAL_DIR", "")
+DIAS_POR_LECTURA_NETCDF = 366
+NOMBRES_COORDENADAS = {
+    'lat': ('latitude', 'lat', 'y'),
+    'lon': ('longitude', 'lon', 'x'),
+    'time': ('time', 'valid_time'),
+}
+# Por orden de preferencia: CHIRPS antes que ERA5 para la lluvia
+VARIABLES_NETCDF_CLIMA = {
+    'precipitacion': ('precip', 'tp', 'pr', 'precipitation'),
+    'temp_media': ('t2m', 'tas', 'temperature_2m_mean'),
+    'temp_max': ('mx2t', 'tasmax', 'tmax'),
+    'temp_min': ('mn2t', 'tasmin', 'tmin'),
+}
+
+def _coordenada(ds, tipo):
+    for nombre in NOMBRES_COORDENADAS[tipo]:
+        if nombre in ds.coords or nombre in ds.dims:
+            return nombre
+    return None
+
+@st.cache_resource(show_spinner=False)
+def _catalogo_netcdf(directorio, firma):
+    """Variables, extensión temporal y coordenadas de cada NetCDF del directorio (sin leer datos)."""
+    import glob
+    catalogo = []
+    for ruta in sorted(glob.glob(os.path.join(directorio, '**', '*.nc'), recursive=True)):
+        try:
+            with xr.open_dataset(ruta) as ds:
+                coords = {t: _coordenada(ds, t) for t in NOMBRES_COORDENADAS}
+                if None in coords.values():
+                    continue
+                tiempos = pd.DatetimeIndex(ds[coords['time']].values)
+                catalogo.append({
+                    'ruta': ruta, 'coords': coords, 'variables': set(ds.data_vars),
+                    'desde': tiempos.min(), 'hasta': tiempos.max()
+                })
+        except Exception:
+            continue
+    return catalogo
+
+def catalogo_clima_local(directorio=None):
+    directorio = directorio or CLIMA_LOCAL_DIR
+    if not directorio or not os.path.isdir(directorio):
+        return []
+    import glob
+    rutas = sorted(glob.glob(os.path.join(directorio, '**', '*.nc'), recursive=True))
+    firma = tuple((r, os.path.getmtime(r)) for r in rutas)
+    return _catalogo_netcdf(directorio, firma)
+
+def _convertir_unidades(valores, unidades):
+    if unidades == 'K':
+        return valores - 273.15
+    if unidades in ('m', 'm of water equivalent'):
+        return valores * 1000.0
+    if unidades in ('kg m-2 s-1', 'kg m**-2 s**-1'):
+        return valores * 86400.0
+    return valores
+
+def _extraer_puntos_netcdf(entrada, variable, lats, lons, fecha_inicio, fecha_fin, metodo):
+    """
+    Serie (días x puntos) de `variable` en los puntos pedidos. Se lee por
+    tramos de tiempo y solo el recorte bbox que rodea los puntos; la selección
+    nearest/bilinear de todos los puntos es una única operación vectorizada.
+    """
+    c = entrada['coords']
+    with xr.open_dataset(entrada['ruta']) as ds:
+        da = ds[variable]
+        lon_archivo = ds[c['lon']].values
+        lons = np.where(lons < 0, lons + 360, lons) if lon_archivo.max() > 180 else lons
+        # Recorte espacial con una celda de margen para la interpolación bilineal
+        recorte = {}
+        for nombre, puntos in ((c['lat'], lats), (c['lon'], lons)):
+            eje = ds[nombre].values
+            paso = np.abs(np.diff(eje[:2])).max() if len(eje) > 1 else 0
+            dentro = np.nonzero((eje >= puntos.min() - paso) & (eje <= puntos.max() + paso))[0]
+            if len(dentro) == 0:
+                return None
+            recorte[nombre] = slice(dentro.min(), dentro.max() + 1)
+        tiempos = pd.DatetimeIndex(ds[c['time']].values)
+        en_rango = np.nonzero((tiempos >= pd.Timestamp(fecha_inicio).normalize())
+                              & (tiempos <= pd.Timestamp(fecha_fin)))[0]
+        if len(en_rango) == 0:
+            return None
+
+        destino = {c['lat']: xr.DataArray(lats, dims='punto'), c['lon']: xr.DataArray(lons, dims='punto')}
+        partes = []
+        for ini in range(en_rango.min(), en_rango.max() + 1, DIAS_POR_LECTURA_NETCDF):
+            fin = min(ini + DIAS_POR_LECTURA_NETCDF, en_rango.max() + 1)
+            bloque = da.isel({c['time']: slice(ini, fin), **recorte}).load()
+            if bloque.sizes[c['lat']] > 1 and bloque.sizes[c['lon']] > 1 and metodo == 'bilinear':
+                valores = bloque.interp(destino, method='linear')
+                # Fuera del recorte o junto a celdas sin dato, se recurre al vecino más próximo
+                cercano = bloque.sel(destino, method='nearest')
+                valores = valores.fillna(cercano)
+            else:
+                valores = bloque.sel(destino, method='nearest')
+            partes.append(valores.transpose(c['time'], 'punto').values)
+        serie = _convertir_unidades(np.concatenate(partes).astype(np.float64), da.attrs.get('units', ''))
+        return pd.DataFrame(serie, index=tiempos[en_rango.min():en_rango.max() + 1].normalize())
+
+def obtener_clima_local(gdf_dividido, fecha_inicio, fecha_fin, metodo='bilinear', directorio=None):
+    """
+    Clima diario por bloque desde NetCDF locales (ERA5 y/o CHIRPS), con la
+    misma estructura que obtener_clima_por_bloque: {variable: DataFrame bloque x día}.
+    """
+    catalogo = catalogo_clima_local(directorio)
+    if not catalogo:
+        raise ValueError("No hay archivos NetCDF en el directorio de clima local (CLIMA_LOCAL_DIR).")
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        centroides = gdf_dividido.geometry.centroid
+    lats, lons = centroides.y.values, centroides.x.values
+    fechas = pd.date_range(pd.Timestamp(fecha_inicio).normalize(), pd.Timestamp(fecha_fin).normalize(), freq='D')
+    ids = gdf_dividido['id_bloque'].values
+
+    resultado = {'n_celdas': len(ids), 'n_llamadas': 0, 'celda': [f"{la:.3f}, {lo:.3f}" for la, lo in zip(lats, lons)]}
+    fuentes = []
+    for nombre, candidatos in VARIABLES_NETCDF_CLIMA.items():
+        variable = next((v for v in candidatos if any(v in e['variables'] for e in catalogo)), None)
+        matriz = pd.DataFrame(np.nan, index=fechas, columns=range(len(ids)))
+        if variable is not None:
+            for entrada in catalogo:
+                if variable not in entrada['variables'] or entrada['hasta'] < fechas[0] or entrada['desde'] > fechas[-1]:
+                    continue
+                parte = _extraer_puntos_netcdf(entrada, variable, lats, lons, fecha_inicio, fecha_fin, metodo)
+                if parte is not None:
+                    parte = parte[~parte.index.duplicated()].reindex(fechas)
+                    matriz = matriz.fillna(parte)
+            fuentes.append(f"{nombre}={variable}")
+        resultado[nombre] = pd.DataFrame(matriz.values.T, index=ids, columns=fechas)
+
+    if resultado['temp_media'].isna().all().all():
+        resultado['temp_media'] = (resultado['temp_max'] + resultado['temp_min']) / 2
+    if resultado['precipitacion'].isna().all().all():
+        raise ValueError("Los NetCDF locales no contienen precipitación para el período.")
+    resultado['precipitacion'] = resultado['precipitacion'].fillna(0.0).clip(lower=0.0)
+    resultado['fuente'] = f"NetCDF local ({', '.join(fuentes)}, {metodo})"
+    return resultado
+
+def resumen_clima_bloques(clima_bloques, fecha_inicio, fecha_fin):
+    """Resumen de la plantación (media de los bloques por día) con el formato de obtener_clima_openmeteo."""
+    precip = clima_bloques['precipitacion']
+    columnas = {'precipitacion': precip.mean(axis=0), 'temp_media': clima_bloques['temp_media'].mean(axis=0)}
+    if clima_bloques['temp_max'].notna().any().any():
+        columnas['temp_max'] = clima_bloques['temp_max'].max(axis=0)
+    if clima_bloques['temp_min'].notna().any().any():
+        columnas['temp_min'] = clima_bloques['temp_min'].min(axis=0)
+    serie = serie_climatica(precip.columns, **{k: v.values for k, v in columnas.items()})
+    return datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, clima_bloques['fuente'])
+
+# ===== BALANCE HÍDRICO (FAO-56) =====
+# ET0 Penman-Monteith diaria (FAO-56) y balance de agua en la zona radicular
+# tipo "cubeta", calculados a la vez para todos los bloques (matrices bloques x días).
+KC_PALMA = 1.0                 # FAO-56 tabla 12, palma aceitera
+PROFUNDIDAD_RAICES_M = 1.0     # FAO-56 tabla 22: 0.7-1.1 m
+FRACCION_AGOTAMIENTO_P = 0.65  # FAO-56 tabla 22
+ALTITUD_DEFECTO_M = 100.0
+MATERIA_ORGANICA_DEFECTO = 2.5  # % para la función de pedotransferencia
+TEXTURA_DEFECTO = {'arena': 40, 'arcilla': 20}  # Franco
+
+def agua_disponible_saxton_rawls(arena, arcilla, mo=MATERIA_ORGANICA_DEFECTO):
+    """Agua útil (m³/m³) entre capacidad de campo y punto de marchitez (Saxton & Rawls, 2006)."""
+    s, c = np.asarray(arena, float) / 100.0, np.asarray(arcilla, float) / 100.0
+    t1500 = -0.024 * s + 0.487 * c + 0.006 * mo + 0.005 * s * mo - 0.013 * c * mo + 0.068 * s * c + 0.031
+    t33 = -0.251 * s + 0.195 * c + 0.011 * mo + 0.006 * s * mo - 0.027 * c * mo + 0.452 * s * c + 0.299
+    theta_1500 = t1500 + (0.14 * t1500 - 0.02)
+    theta_33 = t33 + (1.283 * t33 ** 2 - 0.374 * t33 - 0.015)
+    return np.clip(theta_33 - theta_1500, 0.02, None)
+
+def _presion_vapor(t):
+    return 0.6108 * np.exp(17.27 * t / (t + 237.3))
+
+def et0_penman_monteith(tmax, tmin, rs, u2, lat, dia_juliano, altitud=ALTITUD_DEFECTO_M):
+    """
+    ET0 diaria (mm/día) según FAO-56 (ec. 6) para matrices bloques x días.
+    Sin humedad medida, ea se estima con Tmin (FAO-56 ec. 48). rs en MJ/m²/día,
+    u2 en m/s a 2 m, lat en grados (por bloque).
+    """
+    tmedia = (tmax + tmin) / 2
+    delta = 4098 * _presion_vapor(tmedia) / (tmedia + 237.3) ** 2
+    presion = 101.3 * ((293 - 0.0065 * altitud) / 293) ** 5.26
+    gamma = 0.000665 * presion
+    es = (_presion_vapor(tmax) + _presion_vapor(tmin)) / 2
+    ea = _presion_vapor(tmin)
+
+    phi = np.radians(np.asarray(lat, float))[:, None]
+    j = np.asarray(dia_juliano, float)[None, :]
+    dr = 1 + 0.033 * np.cos(2 * np.pi * j / 365)
+    decl = 0.409 * np.sin(2 * np.pi * j / 365 - 1.39)
+    ws = np.arccos(np.clip(-np.tan(phi) * np.tan(decl), -1, 1))
+    ra = 24 * 60 / np.pi * 0.0820 * dr * (ws * np.sin(phi) * np.sin(decl) + np.cos(phi) * np.cos(decl) * np.sin(ws))
+    rso = (0.75 + 2e-5 * altitud) * ra
+
+    rns = 0.77 * rs
+    rnl = (4.903e-9 * ((tmax + 273.16) ** 4 + (tmin + 273.16) ** 4) / 2
+           * (0.34 - 0.14 * np.sqrt(ea)) * (1.35 * np.clip(rs / rso, 0, 1) - 0.35))
+    rn = rns - rnl
+    et0 = ((0.408 * delta * rn + gamma * 900 / (tmedia + 273) * u2 * (es - ea))
+           / (delta + gamma * (1 + 0.34 * u2)))
+    return np.maximum(et0, 0.0)
+
+BLOQUES_POR_TANDA = 512  # acota la memoria: las matrices intermedias son bloques x días
+
+def _fuente_clima(datos_climaticos, variable, fechas, n_bloques):
+    """
+    Origen de una variable para el balance: (tabla por bloque, serie de la
+    plantación), cada una solo si tiene algún dato. None si no hay ninguna.
+    """
+    por_bloque = datos_climaticos.get('por_bloque') or {}
+    tabla = por_bloque.get(variable)
+    if tabla is None or tabla.shape[0] != n_bloques or not tabla.notna().any().any():
+        tabla = None
+    general = datos_climaticos['serie'].get(variable)
+    if general is None or not general.notna().any():
+        general = None
+    else:
+        general = general.reindex(fechas).to_numpy(dtype=np.float32)
+    return None if tabla is None and general is None else (tabla, general)
+
+def _matriz_clima(fuente, fechas, filas):
+    """Matriz float32 de los bloques de `filas` x días: por bloque si existe, si no la serie de la plantación repetida."""
+    tabla, general = fuente
+    n_filas = filas.stop - filas.start
+    if tabla is None:
+        matriz = np.tile(general, (n_filas, 1))
+    else:
+        matriz = tabla.iloc[filas].reindex(columns=fechas).to_numpy(dtype=np.float32, copy=True)
+        if general is not None:
+            # Bloques sin ningún dato propio (p. ej. NetCDF sin esa variable en su celda)
+            matriz[np.isnan(matriz).all(axis=1)] = general
+    # Huecos: media del propio bloque; si todo falta, NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        medias = np.nanmean(matriz, axis=1, keepdims=True)
+    return np.where(np.isnan(matriz), medias, matriz)
+
+def balance_hidrico_bloques(gdf_dividido, datos_climaticos, textura_por_bloque=None):
+    """
+    Balance hídrico diario FAO-56 de cada bloque. Devuelve matrices bloques x
+    días (ET0, déficit de transpiración, agotamiento) y, por bloque, el déficit
+    acumulado (mm) y los días con estrés. None si faltan datos climáticos.
+    Los bloques sin ET0 calculable quedan en NaN y se cuentan en 'bloques_sin_et0'.
+    """
+    serie = datos_climaticos.get('serie')
+    if serie is None or serie.empty:
+        return None
+    fechas = serie.index
+    n = len(gdf_dividido)
+
+    fuentes = {v: _fuente_clima(datos_climaticos, v, fechas, n)
+               for v in ('precipitacion', 'temp_media', 'temp_max', 'temp_min', 'radiacion', 'viento')}
+    if fuentes['precipitacion'] is None or fuentes['radiacion'] is None or (
+            fuentes['temp_media'] is None and fuentes['temp_max'] is None):
+        return None
+    # Solo hay temperatura media (p. ej. datos simulados o NetCDF con t2m): amplitud térmica típica de 10 °C
+    amplitud_supuesta = fuentes['temp_max'] is None or fuentes['temp_min'] is None
+
+    lat = shapely.get_y(shapely.centroid(np.asarray(gdf_dividido.geometry)))
+    dias = fechas.dayofyear.values
+
+    # Agua útil por bloque según su textura
+    ids = gdf_dividido['id_bloque'].tolist()
+    texturas = {t['id_bloque']: t for t in (textura_por_bloque or [])}
+    if not all(i in texturas for i in ids):
+        texturas = {}
+    arena = np.array([texturas.get(i, TEXTURA_DEFECTO)['arena'] for i in ids])
+    arcilla = np.array([texturas.get(i, TEXTURA_DEFECTO)['arcilla'] for i in ids])
+    taw = 1000 * agua_disponible_saxton_rawls(arena, arcilla) * PROFUNDIDAD_RAICES_M
+    raw = FRACCION_AGOTAMIENTO_P * taw
+
+    # El balance es recursivo en el tiempo pero vectorizado sobre los bloques, por tandas
+    n_dias = len(fechas)
+    et0 = np.empty((n, n_dias), dtype=np.float32)
+    agotamiento = np.empty((n, n_dias), dtype=np.float32)
+    deficit = np.empty((n, n_dias), dtype=np.float32)
+    for inicio in range(0, n, BLOQUES_POR_TANDA):
+        filas = slice(inicio, min(inicio + BLOQUES_POR_TANDA, n))
+        matrices = {v: _matriz_clima(f, fechas, filas) for v, f in fuentes.items() if f is not None}
+        if amplitud_supuesta:
+            tmedia = matrices['temp_media']
+            tmax, tmin = tmedia + 5.0, tmedia - 5.0
+        else:
+            tmax, tmin = matrices['temp_max'], matrices['temp_min']
+        rs = matrices['radiacion']
+        u2 = matrices.get('viento')
+        u2 = np.full_like(rs, 2.0) if u2 is None else u2  # FAO-56 recomienda 2 m/s sin dato
+        precip = np.nan_to_num(matrices['precipitacion'], nan=0.0)
+        et0[filas] = et0_penman_monteith(tmax, tmin, rs, u2, lat[filas], dias)
+
+        etc = KC_PALMA * et0[filas]
+        dr = np.zeros(filas.stop - filas.start, dtype=np.float32)
+        taw_t, raw_t = taw[filas], raw[filas]
+        for d in range(n_dias):
+            ks = np.clip((taw_t - dr) / (taw_t - raw_t), 0.0, 1.0)
+            eta = ks * etc[:, d]
+            dr = np.clip(dr - precip[:, d] + eta, 0.0, taw_t)
+            agotamiento[filas, d] = dr
+            deficit[filas, d] = etc[:, d] - eta
+
+    # Tras rellenar huecos, un bloque sin ET0 no tiene ningún dato de temperatura o radiación
+    sin_et0 = np.isnan(et0).all(axis=1)
+    if sin_et0.all():
+        raise ValueError("No hay temperatura o radiación suficientes para calcular la ET0.")
+
+    return {
+        'fechas': fechas,
+        'ids': ids,
+        'et0': et0,
+        'deficit': deficit,
+        'agotamiento': agotamiento,
+        'taw': taw,
+        'deficit_acumulado': deficit.sum(axis=1, dtype=np.float64),
+        'dias_estres': (deficit > 0.01).sum(axis=1),
+        'bloques_sin_et0': int(sin_et0.sum()),
+        'amplitud_supuesta': amplitud_supuesta,
+        'suelo': [texturas.get(i, {}).get('tipo_suelo', 'Franco (supuesto)') for i in ids]
+    }
+
 # ===== DETECCIÓN DE PALMAS (simulada) =====
 def verificar_puntos_en_poligono(puntos, gdf):
     puntos_dentro = []
@@ -939,9 +2289,7 @@ def mejorar_deteccion_palmas(gdf, densidad=130):
     try:
         bounds = gdf.total_bounds
         min_lon, min_lat, max_lon, max_lat = bounds
-        gdf_proj = gdf.to_crs('EPSG:3857')
-        area_m2 = gdf_proj.geometry.area.sum()
-        area_ha = area_m2 / 10000
+        area_ha = calcular_superficie(gdf)
         if area_ha <= 0:
             return {'detectadas': [], 'total': 0}
         num_palmas_objetivo = int(area_ha * densidad)
@@ -999,113 +2347,88 @@ def ejecutar_deteccion_palmas():
         st.session_state.deteccion_ejecutada = True
         st.success(f"✅ Detección MEJORADA completada: {len(palmas_verificadas)} palmas detectadas")
 
-def crear_graficos_climaticos_completos(datos_climaticos):
-    longitudes = []
-    if 'precipitacion' in datos_climaticos and 'diaria' in datos_climaticos['precipitacion']:
-        longitudes.append(len(datos_climaticos['precipitacion']['diaria']))
-    if 'temperatura' in datos_climaticos and 'diaria' in datos_climaticos['temperatura']:
-        longitudes.append(len(datos_climaticos['temperatura']['diaria']))
-    if 'radiacion' in datos_climaticos and 'diaria' in datos_climaticos['radiacion']:
-        longitudes.append(len(datos_climaticos['radiacion']['diaria']))
-    if 'viento' in datos_climaticos and 'diaria' in datos_climaticos['viento']:
-        longitudes.append(len(datos_climaticos['viento']['diaria']))
-    if not longitudes:
-        st.warning("No hay datos climáticos suficientes para graficar.")
-        return None
+PUNTOS_POR_SERIE = 1000
 
-    n_dias = min(longitudes)
-    dias = list(range(1, n_dias + 1))
+def lttb_indices(x, y, n_puntos):
+    """
+    Índices elegidos por Largest-Triangle-Three-Buckets: conserva la forma
+    visual (picos y valles) de la serie con n_puntos, manteniendo extremos.
+    """
+    n = len(y)
+    if n_puntos >= n or n_puntos < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    bordes = np.linspace(1, n - 1, n_puntos - 1).astype(int)
+    # Media de cada cubeta, usada como tercer vértice del triángulo de la anterior
+    sumas_x = np.add.reduceat(x[1:n - 1], bordes[:-1] - 1)
+    sumas_y = np.add.reduceat(y[1:n - 1], bordes[:-1] - 1)
+    tam = np.diff(bordes)
+    medias_x = np.append(sumas_x / tam, x[-1])
+    medias_y = np.append(sumas_y / tam, y[-1])
 
-    fig, axes = plt.subplots(2, 2, figsize=(15, 10))
+    elegidos = np.empty(n_puntos, dtype=int)
+    elegidos[0], elegidos[-1] = 0, n - 1
+    a = 0
+    for i in range(n_puntos - 2):
+        ini, fin = bordes[i], bordes[i + 1]
+        area = np.abs((x[a] - medias_x[i + 1]) * (y[ini:fin] - y[a])
+                      - (x[a] - x[ini:fin]) * (medias_y[i + 1] - y[a]))
+        a = ini + int(np.argmax(area))
+        elegidos[i + 1] = a
+    return elegidos
 
-    if 'radiacion' in datos_climaticos and datos_climaticos['radiacion'].get('diaria'):
-        rad = np.array(datos_climaticos['radiacion']['diaria'][:n_dias], dtype=np.float64)
-        mask_nan = np.isnan(rad)
-        if np.any(mask_nan):
-            rad_filled = rad.copy()
-            rad_filled[mask_nan] = np.nanmean(rad)
-        else:
-            rad_filled = rad
-        ax1 = axes[0, 0]
-        ax1.plot(dias, rad_filled, 'o-', color='orange', linewidth=2, markersize=4)
-        ax1.fill_between(dias, rad_filled, alpha=0.3, color='orange')
-        if 'promedio' in datos_climaticos['radiacion']:
-            prom_rad = datos_climaticos['radiacion']['promedio']
-            ax1.axhline(y=prom_rad, color='red', linestyle='--', 
-                       label=f"Promedio: {prom_rad} MJ/m²")
-        ax1.set_xlabel('Día')
-        ax1.set_ylabel('Radiación (MJ/m²/día)')
-        ax1.set_title('Radiación Solar', fontweight='bold')
-        ax1.legend()
-        ax1.grid(True, alpha=0.3)
-    else:
-        axes[0, 0].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[0, 0].set_title('Radiación', fontweight='bold')
-
-    if 'precipitacion' in datos_climaticos and datos_climaticos['precipitacion'].get('diaria'):
-        precip = np.array(datos_climaticos['precipitacion']['diaria'][:n_dias], dtype=np.float64)
-        ax2 = axes[0, 1]
-        ax2.bar(dias, precip, color='blue', alpha=0.7)
-        ax2.set_xlabel('Día')
-        ax2.set_ylabel('Precipitación (mm)')
-        total_precip = datos_climaticos['precipitacion'].get('total', np.sum(precip))
-        ax2.set_title(f"Precipitación (Total: {total_precip:.1f} mm)", fontweight='bold')
-        ax2.grid(True, alpha=0.3, axis='y')
-    else:
-        axes[0, 1].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[0, 1].set_title('Precipitación', fontweight='bold')
-
-    if 'viento' in datos_climaticos and datos_climaticos['viento'].get('diaria'):
-        wind = np.array(datos_climaticos['viento']['diaria'][:n_dias], dtype=np.float64)
-        mask_nan = np.isnan(wind)
-        if np.any(mask_nan):
-            wind_filled = wind.copy()
-            wind_filled[mask_nan] = np.nanmean(wind)
-        else:
-            wind_filled = wind
-        ax3 = axes[1, 0]
-        ax3.plot(dias, wind_filled, 's-', color='green', linewidth=2, markersize=4)
-        ax3.fill_between(dias, wind_filled, alpha=0.3, color='green')
-        if 'promedio' in datos_climaticos['viento']:
-            prom_wind = datos_climaticos['viento']['promedio']
-            ax3.axhline(y=prom_wind, color='red', linestyle='--',
-                       label=f"Promedio: {prom_wind} m/s")
-        ax3.set_xlabel('Día')
-        ax3.set_ylabel('Viento (m/s)')
-        ax3.set_title('Velocidad del Viento', fontweight='bold')
-        ax3.legend()
-        ax3.grid(True, alpha=0.3)
-    else:
-        axes[1, 0].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[1, 0].set_title('Viento', fontweight='bold')
-
-    if 'temperatura' in datos_climaticos and datos_climaticos['temperatura'].get('diaria'):
-        temp = np.array(datos_climaticos['temperatura']['diaria'][:n_dias], dtype=np.float64)
-        mask_nan = np.isnan(temp)
-        if np.any(mask_nan):
-            temp_filled = temp.copy()
-            temp_filled[mask_nan] = np.nanmean(temp)
+def reducir_serie(serie, n_puntos=PUNTOS_POR_SERIE):
+    """Serie (índice de fechas) reducida con LTTB; los NaN se descartan antes."""
+    serie = serie.dropna()
+    x = serie.index.values.astype('datetime64[s]').astype(np.int64)
+    return serie.iloc[lttb_indices(x, serie.values, n_puntos)]
+
+def crear_graficos_climaticos_completos(datos_climaticos, desde=None, hasta=None, n_puntos=PUNTOS_POR_SERIE):
+    """
+    Gráfico interactivo (Plotly) de la ventana [desde, hasta]. Cada variable
+    se reduce con LTTB a n_puntos, así el tiempo de dibujo no depende de la
+    longitud del período; al acotar la ventana se recupera el detalle diario.
+    """
+    serie = datos_climaticos.get('serie')
+    if serie is None or serie.empty:
+        st.warning("No hay datos climáticos suficientes para graficar.")
+        return None
+    serie = serie.loc[desde:hasta]
+
+    paneles = [
+        ('radiacion', 'radiacion', 'Radiación (MJ/m²/día)', 'orange'),
+        ('precipitacion', 'precipitacion', 'Precipitación (mm)', 'blue'),
+        ('viento', 'viento', 'Viento (m/s)', 'green'),
+        ('temp_media', 'temperatura', 'Temperatura (°C)', 'red'),
+    ]
+    fig = make_subplots(rows=len(paneles), cols=1, shared_xaxes=True, vertical_spacing=0.04,
+                        subplot_titles=[p[2] for p in paneles])
+    for fila, (columna, resumen, titulo, color) in enumerate(paneles, start=1):
+        if columna not in serie or serie[columna].isna().all():
+            fig.add_annotation(text="Datos no disponibles", showarrow=False,
+                               xref=f"x{fila} domain", yref=f"y{fila} domain", x=0.5, y=0.5)
+            continue
+        reducida = reducir_serie(serie[columna], n_puntos)
+        if columna == 'precipitacion' and len(reducida) == len(serie):
+            fig.add_trace(go.Bar(x=reducida.index, y=reducida.values, marker_color=color, name=titulo), row=fila, col=1)
         else:
-            temp_filled = temp
-        ax4 = axes[1, 1]
-        ax4.plot(dias, temp_filled, '^-', color='red', linewidth=2, markersize=4)
-        ax4.fill_between(dias, temp_filled, alpha=0.3, color='red')
-        if 'promedio' in datos_climaticos['temperatura']:
-            prom_temp = datos_climaticos['temperatura']['promedio']
-            ax4.axhline(y=prom_temp, color='blue', linestyle='--',
-                       label=f"Promedio: {prom_temp}°C")
-        ax4.set_xlabel('Día')
-        ax4.set_ylabel('Temperatura (°C)')
-        ax4.set_title('Temperatura Diaria', fontweight='bold')
-        ax4.legend()
-        ax4.grid(True, alpha=0.3)
-    else:
-        axes[1, 1].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[1, 1].set_title('Temperatura', fontweight='bold')
+            fig.add_trace(go.Scattergl(x=reducida.index, y=reducida.values, mode='lines', line=dict(color=color, width=1.5),
+                                       fill='tozeroy' if columna == 'precipitacion' else None, name=titulo), row=fila, col=1)
+        if columna == 'temp_media':
+            for extremo, tono in (('temp_max', 'rgba(192, 57, 43, 0.35)'), ('temp_min', 'rgba(41, 128, 185, 0.35)')):
+                if extremo in serie and serie[extremo].notna().any():
+                    r = reducir_serie(serie[extremo], n_puntos)
+                    fig.add_trace(go.Scattergl(x=r.index, y=r.values, mode='lines', line=dict(color=tono, width=1),
+                                               name=extremo.replace('temp_', 'T ')), row=fila, col=1)
+        promedio = datos_climaticos.get(resumen, {}).get('promedio')
+        if promedio is not None:
+            fig.add_hline(y=promedio, line_dash='dash', line_color='gray', row=fila, col=1,
+                          annotation_text=f"Promedio: {promedio}", annotation_position='top left')
 
     fuente = datos_climaticos.get('fuente', 'Desconocido')
-    plt.suptitle(f"Datos Climáticos - {fuente}", fontsize=16, fontweight='bold', y=1.02)
-    plt.tight_layout()
+    fig.update_layout(height=900, title=f"Datos Climáticos - {fuente}", showlegend=False, hovermode='x unified')
+    fig.update_xaxes(rangeslider=dict(visible=True, thickness=0.05), row=len(paneles), col=1)
     return fig
 
 # ===== ANÁLISIS DE TEXTURA DE SUELO =====
@@ -1322,7 +2645,7 @@ def crear_mapa_interactivo_base(gdf, columna_color=None, colormap=None, tooltip_
     MiniMap(toggle_display=True).add_to(m)
     return m
 
-def mostrar_estadisticas_indice(gdf, columna, titulo, vmin, vmax, colormap_list):
+def mostrar_estadisticas_indice(gdf, columna, titulo, vmin, vmax, colormap_list, estadisticas=None):
     if columna not in gdf.columns:
         st.error(f"La columna {columna} no está disponible.")
         return
@@ -1369,7 +2692,14 @@ def mostrar_estadisticas_indice(gdf, columna, titulo, vmin, vmax, colormap_list)
     st.markdown("#### Valores por bloque")
     df_tabla = gdf[['id_bloque', columna]].copy()
     df_tabla.columns = ['Bloque', titulo]
-    st.dataframe(df_tabla.style.format({titulo: '{:.3f}'}), use_container_width=True)
+    formatos = {titulo: '{:.3f}'}
+    if estadisticas is not None and len(estadisticas) == len(df_tabla):
+        extra = estadisticas.drop(columns='media').set_axis(df_tabla.index)
+        extra.columns = ['Píxeles', 'Desv.'] + [f'P{p}' for p in PERCENTILES_ZONALES]
+        df_tabla = pd.concat([df_tabla, extra], axis=1)
+        formatos.update({c: '{:.3f}' for c in extra.columns if c != 'Píxeles'})
+        formatos['Píxeles'] = '{:.1f}'
+    st.dataframe(df_tabla.style.format(formatos), use_container_width=True)
 
 def mostrar_comparacion_ndvi_ndwi(gdf):
     if gdf is None or len(gdf) == 0:
@@ -1432,6 +2762,112 @@ def mostrar_comparacion_ndvi_ndwi(gdf):
         bottom_ndwi.columns = ['Bloque', 'NDWI', 'Salud']
         st.dataframe(bottom_ndwi.style.format({'NDWI': '{:.3f}'}), use_container_width=True)
 
+FILAS_MAPA_CALOR = 40
+
+def mostrar_clima_por_bloque(clima_bloques):
+    st.markdown("### 🧭 CLIMA POR BLOQUE")
+    st.caption(f"{clima_bloques['fuente']}: {clima_bloques['n_celdas']} celda(s) únicas, "
+               f"{clima_bloques['n_llamadas']} llamada(s) HTTP")
+    precip = clima_bloques['precipitacion']
+    df_tabla = pd.DataFrame({
+        'Bloque': precip.index,
+        'Celda (lat, lon)': clima_bloques['celda'],
+        'Precipitación total (mm)': precip.sum(axis=1).round(1).values,
+        'Días con lluvia': (precip > 0.1).sum(axis=1).values,
+        'Temp. media (°C)': clima_bloques['temp_media'].mean(axis=1).round(1).values,
+        'Temp. máx. (°C)': clima_bloques['temp_max'].max(axis=1).round(1).values,
+    })
+    st.dataframe(df_tabla, use_container_width=True, hide_index=True)
+
+    # Los bloques de una misma celda comparten serie: el mapa de calor va por celda,
+    # en franjas de latitud si hay demasiadas, y por semana o mes en series largas
+    por_celda = precip.groupby(np.asarray(clima_bloques['celda'])).mean()
+    latitudes = np.array([float(c.split(',')[0]) for c in por_celda.index])
+    por_celda = por_celda.iloc[np.argsort(-latitudes, kind='stable')]
+    if len(por_celda) > FILAS_MAPA_CALOR:
+        franjas = np.array_split(np.arange(len(por_celda)), FILAS_MAPA_CALOR)
+        etiquetas = [f"{por_celda.index[f[0]].split(',')[0]} … {por_celda.index[f[-1]].split(',')[0]}" for f in franjas]
+        por_celda = pd.DataFrame([por_celda.iloc[f].mean() for f in franjas], index=etiquetas)
+    n_dias = por_celda.shape[1]
+    frecuencia, periodo = ('D', 'diaria') if n_dias <= 120 else ('W', 'semanal') if n_dias <= 730 else ('MS', 'mensual')
+    if frecuencia != 'D':
+        por_celda = por_celda.T.resample(frecuencia).sum(min_count=1).T
+    fig = px.imshow(por_celda.values, x=por_celda.columns, y=[str(c) for c in por_celda.index],
+                    color_continuous_scale='Blues', aspect='auto',
+                    labels={'x': 'Fecha', 'y': 'Celda (lat, lon)', 'color': 'mm'})
+    fig.update_layout(height=min(600, max(300, 18 * len(por_celda))), title=f"Precipitación {periodo} por celda")
+    st.plotly_chart(fig, use_container_width=True)
+
+def mostrar_balance_hidrico(balance):
+    st.markdown("### 💧 BALANCE HÍDRICO (FAO-56)")
+    acumulado = balance['deficit_acumulado']
+    validos = ~np.isnan(acumulado)
+    col1, col2, col3, col4 = st.columns(4)
+    with col1: st.metric("ET0 media", f"{np.nanmean(balance['et0']):.1f} mm/día")
+    with col2: st.metric("Déficit acumulado medio", f"{acumulado[validos].mean():.0f} mm")
+    with col3: st.metric("Déficit máximo (bloque)", f"{acumulado[validos].max():.0f} mm")
+    with col4: st.metric("Días con estrés (media)", f"{balance['dias_estres'][validos].mean():.0f}")
+    if balance['bloques_sin_et0']:
+        st.warning(f"⚠️ {balance['bloques_sin_et0']} bloque(s) sin temperatura o radiación: "
+                   "su ET0 y su déficit no se calculan (N/A en la tabla).")
+    if balance['amplitud_supuesta']:
+        st.info("ℹ️ Sin Tmax/Tmin en la fuente climática: se supone una amplitud térmica de ±5 °C sobre la media.")
+
+    curvas = np.cumsum(balance['deficit'][validos], axis=1, dtype=np.float64)
+    media = curvas.mean(axis=0)
+    # Las curvas acumuladas son monótonas: basta con los puntos LTTB de la media
+    idx = lttb_indices(balance['fechas'].values.astype('datetime64[s]').astype(np.int64), media, PUNTOS_POR_SERIE)
+    fechas = balance['fechas'][idx]
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=fechas, y=curvas.max(axis=0)[idx], mode='lines',
+                             line=dict(width=0), showlegend=False, hoverinfo='skip'))
+    fig.add_trace(go.Scatter(x=fechas, y=curvas.min(axis=0)[idx], mode='lines', fill='tonexty',
+                             line=dict(width=0), fillcolor='rgba(211, 84, 0, 0.2)', name='Rango entre bloques'))
+    fig.add_trace(go.Scatter(x=fechas, y=media[idx], mode='lines',
+                             line=dict(color='#d35400', width=2), name='Media de bloques'))
+    fig.update_layout(height=350, title="Déficit hídrico acumulado (ETc − ETa)",
+                      xaxis_title="Fecha", yaxis_title="mm", hovermode='x unified')
+    st.plotly_chart(fig, use_container_width=True)
+
+    df_tabla = pd.DataFrame({
+        'Bloque': balance['ids'],
+        'Suelo': balance['suelo'],
+        'Agua útil (mm)': balance['taw'].round(0),
+        'ET0 total (mm)': balance['et0'].sum(axis=1).round(0),
+        'Déficit acumulado (mm)': acumulado.round(1),
+        'Días con estrés': balance['dias_estres'],
+    })
+    st.dataframe(df_tabla, use_container_width=True, hide_index=True)
+    st.caption("ET0 Penman-Monteith con ea estimada desde Tmin; agua útil por textura (Saxton & Rawls) "
+               f"en {PROFUNDIDAD_RAICES_M:.1f} m de raíces, Kc = {KC_PALMA}, p = {FRACCION_AGOTAMIENTO_P}.")
+
+def mostrar_series_temporales(series_temporales):
+    """Series bloque x fecha: una línea por bloque (o media ± desviación si hay muchos)."""
+    nombres = {'ndvi_modis': 'NDVI', **{c: spec['nombre'] for c, spec in INDICES_ESPECTRALES.items()}}
+    columna = st.selectbox("Índice:", list(series_temporales.keys()),
+                           format_func=lambda c: nombres.get(c, c), key='serie_indice')
+    df_serie = series_temporales[columna]
+    if df_serie.shape[1] == 0:
+        st.info("La serie no tiene fechas.")
+        return
+    fig = go.Figure()
+    if len(df_serie) <= 50:
+        for id_bloque, fila in df_serie.iterrows():
+            fig.add_trace(go.Scatter(x=df_serie.columns, y=fila.values, mode='lines+markers',
+                                     name=f"Bloque {id_bloque}", line=dict(width=1)))
+    else:
+        media = df_serie.mean(axis=0)
+        desv = df_serie.std(axis=0)
+        fig.add_trace(go.Scatter(x=df_serie.columns, y=media + desv, mode='lines', line=dict(width=0),
+                                 showlegend=False))
+        fig.add_trace(go.Scatter(x=df_serie.columns, y=media - desv, mode='lines', line=dict(width=0),
+                                 fill='tonexty', fillcolor='rgba(76,175,80,0.25)', name='± 1 desv.'))
+        fig.add_trace(go.Scatter(x=df_serie.columns, y=media, mode='lines+markers', name='Media de bloques',
+                                 line=dict(color='#2e7d32', width=2)))
+    fig.update_layout(height=450, xaxis_title='Fecha', yaxis_title=nombres.get(columna, columna))
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(f"{df_serie.shape[0]} bloques × {df_serie.shape[1]} fechas")
+
 def crear_mapa_fertilidad_interactivo(gdf_fertilidad, variable, colormap_nombre='YlOrRd'):
     info_var = {
         'N_kg_ha': {'titulo': 'Nitrógeno (N)', 'unidad': 'kg/ha', 'vmin': 40, 'vmax': 180, 'cmap': 'YlGnBu'},
@@ -1707,49 +3143,208 @@ def mapa_curvas_coloreadas(gdf_original, curvas_con_elevacion):
     return m
 
 # ===== FUNCIÓN PRINCIPAL DE ANÁLISIS =====
+def clasificar_salud(ndvi):
+    if ndvi < 0.4: return 'Crítica'
+    if ndvi < 0.6: return 'Baja'
+    if ndvi < 0.75: return 'Moderada'
+    return 'Buena'
+
+def clave_pixeles_sesion(gdf, fecha_inicio, fecha_fin):
+    """Identifica los píxeles decodificados: mismo polígono y mismo rango de fechas."""
+    wkb = b''.join(shapely.to_wkb(np.asarray(gdf.geometry)))
+    rango = f"{pd.Timestamp(fecha_inicio).date()}/{pd.Timestamp(fecha_fin).date()}".encode()
+    return hashlib.sha1(wkb + rango).hexdigest()
+
+def configuracion_clima():
+    """Fuente del resumen climático de la plantación: (fuente_clima, método de interpolación si es local)."""
+    fuente = st.session_state.get('fuente_clima')
+    return (fuente, st.session_state.get('metodo_clima_local', 'bilinear') if fuente == 'local' else None)
+
+def pixeles_sesion_vigentes(gdf, fecha_inicio, fecha_fin):
+    pixeles = st.session_state.get('pixeles_sesion') or {}
+    if pixeles.get('series') and pixeles.get('clave') == clave_pixeles_sesion(gdf, fecha_inicio, fecha_fin):
+        return pixeles
+    return None
+
+def reagregar_series_pixeles(gdf_dividido, series, extras=None):
+    """Recalcula las columnas de índices de una nueva división en bloques sin descargar nada."""
+    gdf_proj = gdf_dividido.to_crs(PROJ4_SINUSOIDAL_MODIS)
+    for serie in series.values():
+        aplicar_serie_a_bloques(gdf_dividido, gdf_proj, serie, extras)
+    if extras is not None:
+        extras['series_pixeles'] = series
+    return gdf_dividido
+
+def es_clima_simulado(resultado):
+    """True si una etapa de clima devolvió la serie simulada de respaldo en lugar de datos reales."""
+    return isinstance(resultado, dict) and str(resultado.get('fuente', '')).startswith('Simulado')
+
+def ejecutar_etapas_concurrentes(etapas):
+    """
+    Ejecuta cada etapa (nombre, etiqueta, función) en su propio hilo dentro de
+    un panel st.status. Un fallo, o un clima que recurrió a datos simulados,
+    marca su panel en rojo pero no cancela las demás; devuelve {nombre: resultado o None}.
+    """
+    paneles = {nombre: st.status(etiqueta, expanded=False) for nombre, etiqueta, _ in etapas}
+
+    def correr(nombre, funcion):
+        t0 = time.time()
+        with paneles[nombre]:
+            resultado = funcion()
+        return resultado, time.time() - t0
+
+    resultados, duraciones = {}, {}
+    t0 = time.time()
+    with _pool_con_contexto(len(etapas)) as pool:
+        futuros = {pool.submit(correr, nombre, funcion): (nombre, etiqueta) for nombre, etiqueta, funcion in etapas}
+        pendientes = set(futuros)
+        while pendientes:
+            hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                nombre, etiqueta = futuros[futuro]
+                try:
+                    resultados[nombre], duraciones[nombre] = futuro.result()
+                except Exception as e:
+                    resultados[nombre], duraciones[nombre] = None, time.time() - t0
+                    paneles[nombre].error(f"❌ {str(e)[:200]}")
+                simulado = es_clima_simulado(resultados[nombre])
+                ok = resultados[nombre] is not None and not simulado
+                paneles[nombre].update(
+                    label=f"{etiqueta} · {duraciones[nombre]:.1f} s" + (" · ⚠️ datos simulados" if simulado else ""),
+                    state='complete' if ok else 'error'
+                )
+    st.caption(f"⏱️ Etapas en paralelo: {time.time() - t0:.1f} s "
+               f"(en secuencia habrían sido ~{sum(duraciones.values()):.1f} s)")
+    return resultados
+
+def combinar_columnas_bloques(gdf_dividido, resultado):
+    """Copia a gdf_dividido las columnas que una etapa añadió sobre su copia de los bloques."""
+    for columna in resultado.columns:
+        if columna not in gdf_dividido.columns:
+            gdf_dividido[columna] = resultado[columna].values
+    return gdf_dividido
+
 def ejecutar_analisis_completo():
     if st.session_state.gdf_original is None:
         st.error("Primero debe cargar un archivo de plantación")
         return
     with st.spinner("Ejecutando análisis completo..."):
         n_divisiones = st.session_state.get('n_divisiones', 16)
+        division = configuracion_division()
         fecha_inicio = st.session_state.get('fecha_inicio', datetime.now() - timedelta(days=60))
         fecha_fin = st.session_state.get('fecha_fin', datetime.now())
         gdf = st.session_state.gdf_original.copy()
         
-        gdf_dividido = dividir_plantacion_en_bloques(gdf, n_divisiones)
-        areas_ha = []
-        for idx, row in gdf_dividido.iterrows():
-            area_gdf = gpd.GeoDataFrame({'geometry': [row.geometry]}, crs=gdf_dividido.crs)
-            areas_ha.append(float(calcular_superficie(area_gdf)))
-        gdf_dividido['area_ha'] = areas_ha
-
-        # 1. Obtener NDVI real
-        st.info("🛰️ Obteniendo NDVI desde Earthdata (MOD13Q1)...")
-        resultado_ndvi = obtener_ndvi_earthdata(gdf_dividido, fecha_inicio, fecha_fin)
-        if resultado_ndvi is None:
-            st.error("No se pudo obtener NDVI real. Verifique su conexión y credenciales de Earthdata.")
-            st.stop()
-        gdf_dividido = resultado_ndvi
-        fuente_ndvi = "Earthdata MOD13Q1"
-
-        # 2. Obtener NDWI real (CORREGIDO)
-        st.info("💧 Obteniendo NDWI desde Earthdata (MOD09GA)...")
-        resultado_ndwi = obtener_ndwi_earthdata(gdf_dividido, fecha_inicio, fecha_fin)
-        if resultado_ndwi is None:
-            st.warning("⚠️ No se pudo obtener NDWI real. Continuando con análisis parcial.")
-            gdf_dividido['ndwi_modis'] = np.nan
-            fuente_ndwi = "No disponible"
+        gdf_dividido = dividir_plantacion_en_bloques(gdf, *division)
+        gdf_dividido['area_ha'] = areas_hectareas(gdf_dividido)
+
+        extras_satelite = {}
+        pixeles = pixeles_sesion_vigentes(gdf, fecha_inicio, fecha_fin)
+        if pixeles is not None:
+            # Solo cambió la división en bloques: se re-agrega desde los píxeles ya decodificados
+            t0 = time.time()
+            reagregar_series_pixeles(gdf_dividido, pixeles['series'], extras_satelite)
+            if 'ndwi_modis' not in gdf_dividido.columns:
+                gdf_dividido['ndwi_modis'] = np.nan
+            fuente_ndvi, fuente_ndwi = pixeles['fuentes']
+            st.info(f"♻️ {len(gdf_dividido)} bloques re-agregados desde los píxeles en memoria "
+                    f"({(time.time() - t0) * 1000:.0f} ms), sin volver a descargar")
+            clima_local = st.session_state.get('fuente_clima') == 'local'
+            clima_bloques = None
+            try:
+                if clima_local:
+                    clima_bloques = obtener_clima_local(
+                        gdf_dividido, fecha_inicio, fecha_fin, st.session_state.get('metodo_clima_local', 'bilinear'))
+                elif st.session_state.get('clima_por_bloque', False):
+                    # Las celdas ya consultadas salen de la caché HTTP
+                    clima_bloques = obtener_clima_por_bloque(gdf_dividido, fecha_inicio, fecha_fin)
+            except Exception as e:
+                st.warning(f"⚠️ Clima por bloque no disponible: {str(e)[:100]}")
+            if pixeles.get('clima') != configuracion_clima():
+                # Cambió la fuente climática: el resumen de la plantación también se rehace
+                # (Open-Meteo y POWER salen de la caché HTTP si ya se consultaron)
+                if clima_local:
+                    if clima_bloques is None:
+                        st.warning("⚠️ Clima local no disponible. Usando datos simulados.")
+                        clima = generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin)
+                    else:
+                        clima = resumen_clima_bloques(clima_bloques, fecha_inicio, fecha_fin)
+                else:
+                    clima = obtener_clima_openmeteo(gdf, fecha_inicio, fecha_fin)
+                power = obtener_radiacion_viento_power(gdf, fecha_inicio, fecha_fin)
+                st.session_state.datos_climaticos = combinar_datos_climaticos(clima, power)
+                pixeles['clima'] = configuracion_clima()
+            st.session_state.datos_climaticos.pop('por_bloque', None)
+            if clima_bloques is not None:
+                st.session_state.datos_climaticos['por_bloque'] = clima_bloques
         else:
-            gdf_dividido = resultado_ndwi
-            fuente_ndwi = "Earthdata MOD09GA"
+            # 1-3. NDVI, índices MOD09 y clima son independientes: cada etapa en su propio hilo,
+            # sobre su propia copia de los bloques, y se combinan al final
+            extras_ndvi, extras_mod09 = {}, {}
+            etapas = [
+                ('ndvi', "🛰️ NDVI desde Earthdata (MOD13Q1)",
+                 lambda: obtener_ndvi_earthdata(gdf_dividido.copy(), fecha_inicio, fecha_fin, extras_ndvi)),
+                ('mod09', "💧 NDWI y demás índices desde Earthdata (MOD09A1)",
+                 lambda: obtener_indices_mod09_earthdata(gdf_dividido.copy(), fecha_inicio, fecha_fin, extras_mod09)),
+                ('clima', "🌦️ Clima de Open-Meteo ERA5",
+                 lambda: obtener_clima_openmeteo(gdf, fecha_inicio, fecha_fin)),
+                ('power', "☀️ Radiación y viento de NASA POWER",
+                 lambda: obtener_radiacion_viento_power(gdf, fecha_inicio, fecha_fin)),
+            ]
+            clima_local = st.session_state.get('fuente_clima') == 'local'
+            metodo_local = st.session_state.get('metodo_clima_local', 'bilinear')
+            if clima_local:
+                # El NetCDF local ya da el clima de cada bloque; el resumen sale de ahí
+                etapas[2] = ('clima', "🗂️ Clima desde NetCDF local (ERA5/CHIRPS)",
+                             lambda: obtener_clima_local(gdf_dividido, fecha_inicio, fecha_fin, metodo_local))
+            elif st.session_state.get('clima_por_bloque', False):
+                etapas.append(('clima_bloques', "🧭 Clima por bloque (celdas ERA5)",
+                               lambda: obtener_clima_por_bloque(gdf_dividido, fecha_inicio, fecha_fin)))
+            resultados_etapas = ejecutar_etapas_concurrentes(etapas)
+            if clima_local:
+                resultados_etapas['clima_bloques'] = resultados_etapas['clima']
+                if resultados_etapas['clima'] is None:
+                    st.warning("⚠️ Clima local no disponible. Usando datos simulados.")
+                    resultados_etapas['clima'] = generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin)
+                else:
+                    resultados_etapas['clima'] = resumen_clima_bloques(resultados_etapas['clima'], fecha_inicio, fecha_fin)
+
+            resultado_ndvi = resultados_etapas['ndvi']
+            if resultado_ndvi is None:
+                st.error("No se pudo obtener NDVI real. Verifique su conexión y credenciales de Earthdata.")
+                st.stop()
+            combinar_columnas_bloques(gdf_dividido, resultado_ndvi)
+            fuente_ndvi = "Earthdata MOD13Q1"
+
+            resultado_ndwi = resultados_etapas['mod09']
+            if resultado_ndwi is None or 'ndwi_modis' not in resultado_ndwi.columns:
+                st.warning("⚠️ No se pudo obtener NDWI real. Continuando con análisis parcial.")
+                gdf_dividido['ndwi_modis'] = np.nan
+                fuente_ndwi = "No disponible"
+            else:
+                combinar_columnas_bloques(gdf_dividido, resultado_ndwi)
+                fuente_ndwi = "Earthdata MOD09A1"
+
+            for extras in (extras_ndvi, extras_mod09):
+                for clave, valor in extras.items():
+                    extras_satelite.setdefault(clave, {}).update(valor)
+
+            clima = resultados_etapas['clima'] or generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin)
+            power = resultados_etapas['power'] or generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin)
+            st.session_state.datos_climaticos = combinar_datos_climaticos(clima, power)
+            if resultados_etapas.get('clima_bloques') is not None:
+                st.session_state.datos_climaticos['por_bloque'] = resultados_etapas['clima_bloques']
+            st.session_state.pixeles_sesion = {
+                'clave': clave_pixeles_sesion(gdf, fecha_inicio, fecha_fin),
+                'series': extras_satelite.get('series_pixeles', {}),
+                'fuentes': (fuente_ndvi, fuente_ndwi),
+                'clima': configuracion_clima()
+            }
 
-        # 3. Datos climáticos
-        st.info("🌦️ Obteniendo datos climáticos de Open-Meteo ERA5...")
-        datos_clima = obtener_clima_openmeteo(gdf, fecha_inicio, fecha_fin) or {}
-        st.info("☀️ Obteniendo radiación y viento de NASA POWER...")
-        datos_power = obtener_radiacion_viento_power(gdf, fecha_inicio, fecha_fin) or {}
-        st.session_state.datos_climaticos = {**datos_clima, **datos_power}
+        clima_bloques = st.session_state.datos_climaticos.get('por_bloque')
+        if clima_bloques is not None:
+            gdf_dividido['precip_total_mm'] = clima_bloques['precipitacion'].sum(axis=1).round(1).values
+            gdf_dividido['temp_media_c'] = clima_bloques['temp_media'].mean(axis=1).round(1).values
 
         # 4. Edad simulada
         edades = analizar_edad_plantacion(gdf_dividido)
@@ -1763,11 +3358,6 @@ def ejecutar_analisis_completo():
         }
 
         # Clasificar salud
-        def clasificar_salud(ndvi):
-            if ndvi < 0.4: return 'Crítica'
-            if ndvi < 0.6: return 'Baja'
-            if ndvi < 0.75: return 'Moderada'
-            return 'Buena'
         gdf_dividido['salud'] = gdf_dividido['ndvi_modis'].apply(clasificar_salud)
 
         # Análisis de suelo
@@ -1778,14 +3368,225 @@ def ejecutar_analisis_completo():
 
         st.session_state.datos_fertilidad = generar_mapa_fertilidad(gdf_dividido)
 
+        # Balance hídrico diario por bloque
+        try:
+            textura = st.session_state.textura_por_bloque if st.session_state.get('analisis_suelo', True) else None
+            balance = balance_hidrico_bloques(gdf_dividido, st.session_state.datos_climaticos, textura)
+        except Exception as e:
+            st.warning(f"⚠️ No se pudo calcular el balance hídrico: {str(e)[:100]}")
+            balance = None
+        if balance is not None:
+            gdf_dividido['deficit_hidrico_mm'] = balance['deficit_acumulado'].round(1)
+
         st.session_state.resultados_todos = {
             'exitoso': True,
             'gdf_completo': gdf_dividido,
-            'area_total': calcular_superficie(gdf)
+            'series_temporales': extras_satelite.get('series_temporales', {}),
+            'estadisticas_zonales': extras_satelite.get('estadisticas_zonales', {}),
+            'area_total': calcular_superficie(gdf),
+            'n_divisiones': n_divisiones,
+            'division': division,
+            'balance_hidrico': balance
         }
         st.session_state.analisis_completado = True
         st.success("✅ Análisis completado!")
 
+# ===== ANÁLISIS POR LOTES =====
+# Los lotes se agrupan por zona: cada zona descarga una sola vez la serie MODIS
+# de la ventana que cubre sus lotes (los gránulos ya se comparten por la caché en
+# disco) y el clima ERA5 se pide una vez para todas las celdas distintas. Cada lote
+# solo divide en bloques y re-agrega desde esos datos compartidos.
+GRADOS_ZONA_LOTES = 0.5
+MAX_HILOS_LOTES = 4
+COLUMNAS_TABLA_LOTES = {
+    'nombre_lote': 'Lote', 'area_ha': 'Área (ha)', 'n_bloques': 'Bloques', 'ndvi_modis': 'NDVI',
+    'ndwi_modis': 'NDWI', 'pct_bloques_criticos': '% bloques críticos/bajos',
+    'precip_total_mm': 'Precipitación (mm)', 'temp_media_c': 'Temp. media (°C)',
+    'et0_media_mm': 'ET0 media (mm/día)', 'deficit_hidrico_mm': 'Déficit hídrico (mm)',
+}
+
+def agrupar_lotes_por_zona(lotes, grados=GRADOS_ZONA_LOTES):
+    """{zona: índices de los lotes} según la celda de `grados` que contiene el centroide de cada lote."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        centroides = lotes.geometry.centroid
+    zonas = list(zip(np.floor(centroides.x.values / grados).astype(int),
+                     np.floor(centroides.y.values / grados).astype(int)))
+    grupos = {}
+    for i, zona in zip(lotes.index, zonas):
+        grupos.setdefault(zona, []).append(i)
+    return grupos
+
+def obtener_datos_zona(lotes_zona, fecha_inicio, fecha_fin, registro):
+    """Series de píxeles MODIS y radiación/viento POWER de una zona, compartidas por todos sus lotes."""
+    gdf_zona = gpd.GeoDataFrame({'id_bloque': lotes_zona['id_lote'].values},
+                                geometry=lotes_zona.geometry.values, crs=lotes_zona.crs)
+    extras = {}
+    with registro:
+        st.markdown(f"**Zona de {len(lotes_zona)} lote(s):** {', '.join(lotes_zona['nombre_lote'].astype(str)[:5])}"
+                    f"{'…' if len(lotes_zona) > 5 else ''}")
+        obtener_ndvi_earthdata(gdf_zona.copy(), fecha_inicio, fecha_fin, extras)
+        obtener_indices_mod09_earthdata(gdf_zona.copy(), fecha_inicio, fecha_fin, extras)
+        power = obtener_radiacion_viento_power(gdf_zona, fecha_inicio, fecha_fin)
+    return {'series': extras.get('series_pixeles', {}), 'power': power}
+
+def obtener_clima_lotes(lotes, fecha_inicio, fecha_fin):
+    """Clima diario de cada lote (lote x día) en una sola pasada: celdas ERA5 únicas o NetCDF local."""
+    gdf_lotes = gpd.GeoDataFrame({'id_bloque': lotes['id_lote'].values}, geometry=lotes.geometry.values, crs=lotes.crs)
+    if st.session_state.get('fuente_clima') == 'local':
+        return obtener_clima_local(gdf_lotes, fecha_inicio, fecha_fin, st.session_state.get('metodo_clima_local', 'bilinear'))
+    return obtener_clima_por_bloque(gdf_lotes, fecha_inicio, fecha_fin)
+
+def datos_climaticos_lote(lote, clima_lotes, power, fecha_inicio, fecha_fin):
+    id_lote = lote['id_lote'].iloc[0]
+    if clima_lotes is not None:
+        columnas = {}
+        for variable in ('precipitacion', 'temp_media', 'temp_max', 'temp_min'):
+            fila = clima_lotes[variable].loc[id_lote]
+            if fila.notna().any():
+                columnas[variable] = fila.values
+        serie = serie_climatica(clima_lotes['precipitacion'].columns, **columnas)
+        clima = datos_climaticos_desde_serie(serie, fecha_inicio, fecha_fin, clima_lotes['fuente'])
+    else:
+        clima = generar_datos_climaticos_simulados(lote, fecha_inicio, fecha_fin)
+    return combinar_datos_climaticos(clima, power or generar_datos_climaticos_simulados(lote, fecha_inicio, fecha_fin))
+
+def analizar_lote(lote, datos_zona, clima_lotes, fecha_inicio, fecha_fin, division):
+    """Fila de resultados de un lote: división en bloques, índices desde los píxeles de su zona, clima y balance hídrico."""
+    gdf_dividido = dividir_plantacion_en_bloques(lote[['geometry']], *division)
+    gdf_dividido['area_ha'] = areas_hectareas(gdf_dividido)
+    if datos_zona['series']:
+        reagregar_series_pixeles(gdf_dividido, datos_zona['series'])
+    fila = {
+        'id_lote': int(lote['id_lote'].iloc[0]),
+        'nombre_lote': lote['nombre_lote'].iloc[0],
+        'area_ha': round(float(gdf_dividido['area_ha'].sum()), 2),
+        'n_bloques': len(gdf_dividido),
+    }
+    for columna in ('ndvi_modis', 'ndwi_modis'):
+        fila[columna] = round(float(gdf_dividido[columna].mean()), 3) if columna in gdf_dividido else np.nan
+    if 'ndvi_modis' in gdf_dividido:
+        salud = gdf_dividido['ndvi_modis'].dropna().apply(clasificar_salud)
+        fila['pct_bloques_criticos'] = round(float(salud.isin(['Crítica', 'Baja']).mean() * 100), 1) if len(salud) else np.nan
+
+    datos_climaticos = datos_climaticos_lote(lote, clima_lotes, datos_zona['power'], fecha_inicio, fecha_fin)
+    # Una fuente sin alguna variable (p. ej. NetCDF local sin temperatura) deja la celda vacía
+    fila['precip_total_mm'] = datos_climaticos.get('precipitacion', {}).get('total', np.nan)
+    fila['temp_media_c'] = datos_climaticos.get('temperatura', {}).get('promedio', np.nan)
+    try:
+        balance = balance_hidrico_bloques(gdf_dividido, datos_climaticos)
+    except ValueError:
+        balance = None  # sin ET0 calculable: las columnas del balance quedan vacías
+    if balance is not None:
+        fila['et0_media_mm'] = round(float(np.nanmean(balance['et0'])), 2)
+        fila['deficit_hidrico_mm'] = round(float(np.nanmean(balance['deficit_acumulado'])), 1)
+    fila['fuente_clima'] = datos_climaticos.get('fuente')
+    return fila
+
+def tabla_lotes(filas):
+    df = pd.DataFrame(filas).sort_values('id_lote')
+    return df[[c for c in COLUMNAS_TABLA_LOTES if c in df.columns]].rename(columns=COLUMNAS_TABLA_LOTES)
+
+def ejecutar_analisis_lotes():
+    """
+    Analiza todos los lotes cargados. Las zonas y el clima se obtienen en un
+    pool de hilos; en cuanto una zona termina, sus lotes se analizan en el
+    mismo pool y cada resultado se añade a la tabla combinada sin esperar al resto.
+    """
+    lotes = st.session_state.get('lotes')
+    if lotes is None:
+        st.error("No hay lotes cargados")
+        return
+    fecha_inicio = st.session_state.get('fecha_inicio', datetime.now() - timedelta(days=60))
+    fecha_fin = st.session_state.get('fecha_fin', datetime.now())
+    division = configuracion_division()
+    zonas = agrupar_lotes_por_zona(lotes)
+
+    t0 = time.time()
+    progress_bar = st.progress(0, text=f"Analizando {len(lotes)} lotes en {len(zonas)} zona(s)...")
+    tabla = st.empty()
+    registro = st.expander("📜 Registro de descargas por zona")
+    filas, errores = [], []
+    clima_lotes, clima_listo, zonas_listas = None, False, []
+    with _pool_con_contexto(MAX_HILOS_LOTES) as pool:
+        futuro_clima = pool.submit(obtener_clima_lotes, lotes, fecha_inicio, fecha_fin)
+        futuros_zona = {pool.submit(obtener_datos_zona, lotes.loc[indices], fecha_inicio, fecha_fin, registro): indices
+                        for indices in zonas.values()}
+        futuros_lote = {}
+        pendientes = set(futuros_zona) | {futuro_clima}
+        while pendientes:
+            hechos, pendientes = wait(pendientes, timeout=0.5, return_when=FIRST_COMPLETED)
+            nuevas_filas = False
+            for futuro in hechos:
+                if futuro is futuro_clima:
+                    clima_listo = True
+                    try:
+                        clima_lotes = futuro.result()
+                    except Exception as e:
+                        errores.append(f"Clima por lote no disponible, se usan datos simulados: {str(e)[:100]}")
+                elif futuro in futuros_zona:
+                    try:
+                        zonas_listas.append((futuros_zona[futuro], futuro.result()))
+                    except Exception as e:
+                        errores.append(f"Zona sin datos satelitales: {str(e)[:100]}")
+                        zonas_listas.append((futuros_zona[futuro], {'series': {}, 'power': None}))
+                else:
+                    try:
+                        filas.append(futuro.result())
+                        nuevas_filas = True
+                    except Exception as e:
+                        errores.append(f"{futuros_lote[futuro]}: {str(e)[:100]}")
+            # Los lotes de una zona se lanzan cuando están sus datos y el clima compartido
+            if clima_listo:
+                for indices, datos_zona in zonas_listas:
+                    for i in indices:
+                        lote = lotes.loc[[i]]
+                        futuro = pool.submit(analizar_lote, lote, datos_zona, clima_lotes, fecha_inicio, fecha_fin, division)
+                        futuros_lote[futuro] = lote['nombre_lote'].iloc[0]
+                        pendientes.add(futuro)
+                zonas_listas = []
+            if nuevas_filas:
+                tabla.dataframe(tabla_lotes(filas), use_container_width=True, hide_index=True)
+            progress_bar.progress(len(filas) / len(lotes),
+                                  text=f"{len(filas)}/{len(lotes)} lotes analizados · {time.time() - t0:.0f} s")
+    progress_bar.empty()
+    tabla.empty()
+
+    for error in errores[:10]:
+        st.warning(f"⚠️ {error}")
+    st.session_state.resultados_lotes = {
+        'filas': filas,
+        'duracion': time.time() - t0,
+        'n_zonas': len(zonas),
+        'division': division
+    }
+
+def mostrar_resultados_lotes(resultados_lotes, lotes):
+    filas = resultados_lotes['filas']
+    if not filas:
+        st.warning("Ningún lote pudo analizarse.")
+        return
+    df = pd.DataFrame(filas).sort_values('id_lote')
+    st.caption(f"{len(filas)}/{len(lotes)} lotes en {resultados_lotes['duracion']:.0f} s "
+               f"({resultados_lotes['n_zonas']} zona(s) de descarga compartida)")
+    col1, col2, col3, col4 = st.columns(4)
+    with col1: st.metric("Área analizada", f"{df['area_ha'].sum():.0f} ha")
+    with col2: st.metric("Bloques", f"{df['n_bloques'].sum()}")
+    with col3: st.metric("NDVI medio", f"{df['ndvi_modis'].mean():.3f}" if df['ndvi_modis'].notna().any() else "N/A")
+    with col4: st.metric("Déficit hídrico medio", f"{df['deficit_hidrico_mm'].mean():.0f} mm"
+                         if 'deficit_hidrico_mm' in df and df['deficit_hidrico_mm'].notna().any() else "N/A")
+    st.dataframe(tabla_lotes(filas), use_container_width=True, hide_index=True)
+
+    # Los atributos originales de cada lote acompañan a los resultados en la exportación
+    gdf_lotes = lotes.merge(df.drop(columns=['nombre_lote']), on='id_lote', how='left')
+    col_dl1, col_dl2 = st.columns(2)
+    with col_dl1:
+        st.download_button("📊 CSV de lotes", gdf_lotes.drop(columns='geometry').to_csv(index=False),
+                           f"lotes_{datetime.now():%Y%m%d}.csv", "text/csv")
+    with col_dl2:
+        st.download_button("🗺️ GeoJSON de lotes", gdf_lotes.to_json(default=str),
+                           f"lotes_{datetime.now():%Y%m%d}.geojson", "application/geo+json")
+
 # ===== SIDEBAR =====
 with st.sidebar:
     st.markdown("## 🌴 CONFIGURACIÓN")
@@ -1807,8 +3608,17 @@ with st.sidebar:
     
     st.markdown("---")
     st.markdown("### 🎯 División de Plantación")
-    n_divisiones = st.slider("Número de bloques:", 8, 32, 16)
-    st.session_state.n_divisiones = n_divisiones
+    st.session_state.forma_bloque = st.radio("Forma de bloque:", list(FORMAS_BLOQUE), format_func=FORMAS_BLOQUE.get,
+                                             horizontal=True)
+    modo_division = st.radio("Definir bloques por:", ["Número de bloques", "Tamaño de celda"], horizontal=True)
+    if modo_division == "Número de bloques":
+        st.session_state.n_divisiones = st.number_input("Número de bloques (aprox.):", min_value=4,
+                                                        max_value=MAX_BLOQUES, value=16, step=4)
+        st.session_state.tamano_bloque_m = None
+    else:
+        st.session_state.tamano_bloque_m = st.number_input(
+            "Tamaño de celda (m):", min_value=20, max_value=5000, value=150, step=10,
+            help="Lado del cuadrado o ancho del hexágono. 100 m ≈ 1 ha; 224 m ≈ 5 ha.")
     
     st.markdown("---")
     st.markdown("### 🌴 Detección de Palmas")
@@ -1817,6 +3627,24 @@ with st.sidebar:
         densidad_personalizada = st.slider("Densidad objetivo (plantas/ha):", 50, 200, 130)
         st.session_state.densidad_personalizada = densidad_personalizada
     
+    st.markdown("---")
+    st.markdown("### 🌦️ Clima")
+    fuentes_clima = {'openmeteo': "Open-Meteo ERA5 (en línea)", 'local': "NetCDF local (ERA5/CHIRPS)"}
+    st.session_state.fuente_clima = st.selectbox(
+        "Fuente de clima:", list(fuentes_clima), format_func=fuentes_clima.get,
+        index=list(fuentes_clima).index(st.session_state.fuente_clima)
+    )
+    if st.session_state.fuente_clima == 'local':
+        st.session_state.metodo_clima_local = st.radio("Extracción por bloque:", ['bilinear', 'nearest'], horizontal=True)
+        n_archivos = len(catalogo_clima_local())
+        if n_archivos:
+            st.caption(f"{n_archivos} archivo(s) NetCDF en {CLIMA_LOCAL_DIR}")
+        else:
+            st.warning("Defina CLIMA_LOCAL_DIR con los NetCDF de ERA5/CHIRPS.")
+    clima_por_bloque = st.checkbox("Clima por bloque (celdas ERA5)", value=False,
+                                   help="Consulta Open-Meteo en cada celda ERA5 de 0.25° que cubre los bloques")
+    st.session_state.clima_por_bloque = clima_por_bloque
+
     st.markdown("---")
     st.markdown("### 🧪 Análisis de Suelo")
     analisis_suelo = st.checkbox("Activar análisis de suelo", value=True)
@@ -1829,8 +3657,8 @@ with st.sidebar:
     
     uploaded_file = st.file_uploader(
         "Subir archivo de plantación", 
-        type=['zip', 'kml', 'kmz', 'geojson'],
-        help="Formatos: Shapefile (.zip), KML (.kmz), GeoJSON (.geojson)",
+        type=FORMATOS_PLANTACION,
+        help="Formatos: Shapefile (.zip), KML/KMZ, GeoJSON, GeoPackage (.gpkg), GeoParquet (.parquet)",
         key="polygon_uploader"
     )
 
@@ -1845,6 +3673,19 @@ with st.sidebar:
                     st.success("✅ Polígono cargado correctamente")
                     st.rerun()
 
+    st.markdown("---")
+    with st.expander("🗄️ Caché de gránulos MODIS y clima"):
+        try:
+            cache_info = estadisticas_cache_granulos()
+            st.write(f"- **Aciertos / fallos:** {cache_info['aciertos']} / {cache_info['fallos']}")
+            st.write(f"- **Gránulos en disco:** {cache_info['archivos']}")
+            st.write(f"- **Uso:** {cache_info['mb']:.0f} / {cache_info['max_mb']:.0f} MB")
+            http_info = estadisticas_cache_http()
+            st.write(f"- **Clima (HTTP):** {http_info['aciertos']} desde caché, "
+                     f"{http_info['llamadas']} llamadas, {http_info['respuestas']} respuestas guardadas")
+        except Exception as e:
+            st.caption(f"Caché no disponible: {e}")
+
     if st.session_state.get('archivo_cargado', False):
         st.success("✅ Polígono cargado en memoria")
         if st.session_state.get('gdf_original') is not None:
@@ -1854,6 +3695,10 @@ with st.sidebar:
 # ===== ÁREA PRINCIPAL =====
 if st.session_state.archivo_cargado and st.session_state.gdf_original is not None:
     gdf = st.session_state.gdf_original
+    if (st.session_state.analisis_completado
+            and st.session_state.resultados_todos.get('division') != configuracion_division()
+            and pixeles_sesion_vigentes(gdf, st.session_state.fecha_inicio, st.session_state.fecha_fin)):
+        ejecutar_analisis_completo()
     try:
         area_total = calcular_superficie(gdf)
     except:
@@ -1864,7 +3709,12 @@ if st.session_state.archivo_cargado and st.session_state.gdf_original is not Non
         st.markdown("### 📊 INFORMACIÓN DE LA PLANTACIÓN")
         st.write(f"- **Área total:** {area_total:.1f} ha")
         st.write(f"- **Variedad:** {st.session_state.variedad_seleccionada}")
-        st.write(f"- **Bloques configurados:** {st.session_state.n_divisiones}")
+        if st.session_state.tamano_bloque_m:
+            st.write(f"- **Bloques configurados:** celdas de {st.session_state.tamano_bloque_m} m "
+                     f"({FORMAS_BLOQUE[st.session_state.forma_bloque].lower()})")
+        else:
+            st.write(f"- **Bloques configurados:** ~{st.session_state.n_divisiones} "
+                     f"({FORMAS_BLOQUE[st.session_state.forma_bloque].lower()})")
         
         st.markdown("#### 🗺️ Vista previa del polígono")
         try:
@@ -1895,11 +3745,19 @@ if st.session_state.archivo_cargado and st.session_state.gdf_original is not Non
                 if st.button("🔍 DETECTAR PALMAS", use_container_width=True):
                     ejecutar_deteccion_palmas()
                     st.rerun()
+
+    lotes = st.session_state.get('lotes')
+    if lotes is not None:
+        st.markdown(f"### 📦 ANÁLISIS POR LOTES ({len(lotes)} lotes)")
+        if st.button(f"🚀 ANALIZAR LOS {len(lotes)} LOTES", key="analizar_lotes_btn"):
+            ejecutar_analisis_lotes()
+        if st.session_state.get('resultados_lotes'):
+            mostrar_resultados_lotes(st.session_state.resultados_lotes, lotes)
 else:
     st.info("👆 Por favor, sube un archivo de plantación en la barra lateral para comenzar.")
     st.markdown("""
     ### ¿Cómo empezar?
-    1. Sube un archivo con el polígono de tu plantación (formatos: Shapefile .zip, KML, KMZ, GeoJSON).
+    1. Sube un archivo con el polígono de tu plantación (formatos: Shapefile .zip, KML, KMZ, GeoJSON, GeoPackage, GeoParquet).
     2. Configura los parámetros de análisis.
     3. Haz clic en EJECUTAR ANÁLISIS para obtener resultados.
     """)
@@ -2068,25 +3926,44 @@ if st.session_state.analisis_completado:
             
             st.markdown("### 🌿 NDVI")
             if 'ndvi_modis' in gdf_completo.columns:
-                mostrar_estadisticas_indice(gdf_completo, 'ndvi_modis', 'NDVI', 0.3, 0.9, ['red','yellow','green'])
+                mostrar_estadisticas_indice(gdf_completo, 'ndvi_modis', 'NDVI', 0.3, 0.9, ['red','yellow','green'],
+                                            resultados.get('estadisticas_zonales', {}).get('ndvi_modis'))
             else:
                 st.error("No hay datos de NDVI disponibles.")
             
             st.markdown("---")
             st.markdown("### 💧 NDWI")
-            st.info("NDWI calculado como (NIR - SWIR)/(NIR+SWIR) con bandas de MODIS (producto MOD09GA).")
+            st.info("NDWI calculado como (NIR - SWIR)/(NIR+SWIR) con bandas de MODIS (producto MOD09A1, compuesto de 8 días).")
             if 'ndwi_modis' in gdf_completo.columns:
-                mostrar_estadisticas_indice(gdf_completo, 'ndwi_modis', 'NDWI', 0.1, 0.7, ['brown','yellow','blue'])
+                mostrar_estadisticas_indice(gdf_completo, 'ndwi_modis', 'NDWI', 0.1, 0.7, ['brown','yellow','blue'],
+                                            resultados.get('estadisticas_zonales', {}).get('ndwi_modis'))
             else:
                 st.error("No hay datos de NDWI disponibles.")
             
+            series_temporales = resultados.get('series_temporales', {})
+            if series_temporales:
+                st.markdown("---")
+                st.markdown("### 📈 Serie temporal por bloque")
+                mostrar_series_temporales(series_temporales)
+            
             st.markdown("---")
             mostrar_comparacion_ndvi_ndwi(gdf_completo)
             
+            otros_indices = [c for c in INDICES_ESPECTRALES if c != 'ndwi_modis' and c in gdf_completo.columns]
+            if otros_indices:
+                st.markdown("---")
+                st.markdown("### 🧮 Otros índices espectrales (MOD09)")
+                indice_sel = st.selectbox("Índice:", otros_indices,
+                                          format_func=lambda c: INDICES_ESPECTRALES[c]['nombre'], key='indice_mod09')
+                spec = INDICES_ESPECTRALES[indice_sel]
+                mostrar_estadisticas_indice(gdf_completo, indice_sel, spec['nombre'], spec['vmin'], spec['vmax'],
+                                            spec['colores'], resultados.get('estadisticas_zonales', {}).get(indice_sel))
+            
             st.markdown("### 📥 EXPORTAR")
             try:
-                gdf_indices = gdf_completo[['id_bloque','ndvi_modis','ndwi_modis','salud','geometry']].copy()
-                gdf_indices.columns = ['id_bloque','NDVI','NDWI','Salud','geometry']
+                gdf_indices = gdf_completo[['id_bloque','ndvi_modis','ndwi_modis'] + otros_indices + ['salud','geometry']].copy()
+                gdf_indices.columns = (['id_bloque','NDVI','NDWI'] + [INDICES_ESPECTRALES[c]['nombre'] for c in otros_indices]
+                                       + ['Salud','geometry'])
                 geojson_indices = gdf_indices.to_json()
                 csv_indices = gdf_indices.drop(columns='geometry').to_csv(index=False)
                 col_dl1, col_dl2 = st.columns(2)
@@ -2106,14 +3983,26 @@ if st.session_state.analisis_completado:
                 with col4: st.metric("Radiación promedio", f"{datos_climaticos.get('radiacion',{}).get('promedio', 'N/A')} MJ/m²")
                 st.markdown("### 📈 GRÁFICOS CLIMÁTICOS COMPLETOS")
                 try:
-                    fig_clima = crear_graficos_climaticos_completos(datos_climaticos)
-                    st.pyplot(fig_clima); plt.close(fig_clima)
+                    fechas_serie = datos_climaticos['serie'].index
+                    desde, hasta = fechas_serie.min().date(), fechas_serie.max().date()
+                    if len(fechas_serie) > PUNTOS_POR_SERIE:
+                        desde, hasta = st.slider("Ventana", min_value=desde, max_value=hasta, value=(desde, hasta),
+                                                 format="YYYY-MM-DD", key="ventana_clima")
+                        st.caption(f"Cada serie se muestra con hasta {PUNTOS_POR_SERIE} puntos (LTTB); "
+                                   "acote la ventana para ver el detalle diario.")
+                    fig_clima = crear_graficos_climaticos_completos(datos_climaticos, pd.Timestamp(desde), pd.Timestamp(hasta))
+                    if fig_clima is not None:
+                        st.plotly_chart(fig_clima, use_container_width=True)
                 except Exception as e:
                     st.error(f"Error al mostrar gráficos climáticos: {str(e)[:100]}")
                 st.markdown("### 📋 INFORMACIÓN ADICIONAL")
                 st.write(f"- **Fuente precipitación/temperatura:** {datos_climaticos.get('fuente', 'N/A')}")
-                st.write(f"- **Fuente radiación/viento:** NASA POWER")
+                st.write(f"- **Fuente radiación/viento:** {datos_climaticos.get('fuente_radiacion', 'N/A')}")
                 st.write(f"- **Período:** {datos_climaticos['periodo']}")
+                if 'por_bloque' in datos_climaticos:
+                    mostrar_clima_por_bloque(datos_climaticos['por_bloque'])
+                if resultados.get('balance_hidrico') is not None:
+                    mostrar_balance_hidrico(resultados['balance_hidrico'])
             else:
                 st.info("No hay datos climáticos disponibles")
         
@@ -0,0 +1,75 @@
+import json
+import os
+import runpy
+import warnings
+from datetime import datetime
+
+import pandas as pd
+import pytest
+import xarray as xr
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+@pytest.fixture(scope='module')
+def intervalos_pendientes():
+    # app.py es un script de Streamlit: se ejecuta en modo "bare" y se toma la función
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return runpy.run_path(RUTA_APP)['intervalos_pendientes']
+
+
+def cubo(consultados, fechas, incompletas=()):
+    return xr.Dataset(coords={'time': pd.DatetimeIndex(fechas)}, attrs={
+        'intervalos_consultados': json.dumps(consultados),
+        'fechas_incompletas': json.dumps(list(incompletas)),
+    })
+
+
+CUBO_2024 = cubo([('2024-01-01', '2024-12-18')], pd.date_range('2024-01-01', '2024-12-18', freq='16D'))
+
+
+def d(texto):
+    return datetime.strptime(texto, '%Y-%m-%d')
+
+
+def test_sin_cubo_pide_todo(intervalos_pendientes):
+    assert intervalos_pendientes(None, d('2024-01-01'), d('2024-03-01')) == [(d('2024-01-01'), d('2024-03-01'))]
+
+
+def test_rango_cubierto(intervalos_pendientes):
+    assert intervalos_pendientes(CUBO_2024, d('2024-03-01'), d('2024-06-01')) == []
+
+
+def test_antes(intervalos_pendientes):
+    assert intervalos_pendientes(CUBO_2024, d('2022-01-01'), d('2022-03-31')) == [(d('2022-01-01'), d('2022-03-31'))]
+
+
+def test_despues(intervalos_pendientes):
+    assert intervalos_pendientes(CUBO_2024, d('2024-12-01'), d('2025-01-31')) == [(d('2024-12-19'), d('2025-01-31'))]
+
+
+def test_solapes_a_ambos_lados(intervalos_pendientes):
+    assert intervalos_pendientes(CUBO_2024, d('2023-12-01'), d('2025-01-31')) == [
+        (d('2023-12-01'), d('2023-12-31')), (d('2024-12-19'), d('2025-01-31'))]
+
+
+def test_hueco_entre_consultas(intervalos_pendientes):
+    # Tras consultar 2022-01..03, el tramo 2023-06..09 sigue pendiente aunque quede antes de 2024
+    c = cubo([('2022-01-01', '2022-03-31'), ('2024-01-01', '2024-12-18')],
+             list(pd.date_range('2022-01-01', '2022-03-31', freq='16D')) + list(CUBO_2024['time'].values))
+    assert intervalos_pendientes(c, d('2023-06-01'), d('2023-09-30')) == [(d('2023-06-01'), d('2023-09-30'))]
+    assert intervalos_pendientes(c, d('2022-03-01'), d('2024-02-01')) == [(d('2022-04-01'), d('2023-12-31'))]
+
+
+def test_fechas_incompletas(intervalos_pendientes):
+    c = cubo([('2024-01-01', '2024-12-18')], CUBO_2024['time'].values, incompletas=['2024-02-02T00:00:00'])
+    assert intervalos_pendientes(c, d('2024-01-01'), d('2024-03-01')) == [(d('2024-02-02'), d('2024-02-02'))]
+    assert intervalos_pendientes(c, d('2024-03-01'), d('2024-04-01')) == []
+
+
+def test_cubo_antiguo_con_consultado_desde(intervalos_pendientes):
+    c = xr.Dataset(coords={'time': pd.DatetimeIndex(['2024-01-01', '2024-01-17'])},
+                   attrs={'consultado_desde': '2024-01-01T00:00:00'})
+    assert intervalos_pendientes(c, d('2023-12-01'), d('2024-02-01')) == [
+        (d('2023-12-01'), d('2023-12-31')), (d('2024-01-18'), d('2024-02-01'))]